@@ -1,50 +1,133 @@
 #!/bin/python
-from pprint import pprint
 import json
+import hashlib
 import re
-import netaddr
 import os
-from amazon_client import Cloudformation
+import time
+import zipfile
+from graph import (
+    DependencyGraph,
+    as_list,
+    dependency_order,
+    find_cycle,
+    find_references
+)
 from helper import (
-    Resource
+    Resource,
+    SubnetAllocator
+)
+from stats import NULL_STATS
+from template import (
+    TemplateOutput,
+    TemplateResource,
+    intrinsic,
+    readonly
 )
 
 
+FRAGMENT_MODES = ("files", "deferred", "ndjson", "archive", None)
+CF_INLINE_LIMIT = 51200
+CF_S3_LIMIT = 1048576
+CF_OUTPUT_LIMIT = 200
+CF_PARAMETER_LIMIT = 200
+CF_RESOURCE_LIMIT = 500
+# pseudo parameters that name the stack, inside a nested template they would name the
+# nested stack, so shard passes the parent's value down as these parameters instead
+PARENT_PARAMETERS = {"AWS::StackName": "ParentStackName", "AWS::StackId": "ParentStackId"}
+
+
+def localise(obj, owner, stack, parameters):
+    '''Copies obj for the nested template stack, turning references to resources that live in
+    other nested templates into Refs to parameters, which are collected in parameters.
+    AWS::StackName and AWS::StackId become the PARENT_PARAMETERS, set from the parent stack'''
+    if isinstance(obj, dict):
+        if len(obj) == 1 and obj.get("Ref") in PARENT_PARAMETERS:
+            parameters[PARENT_PARAMETERS[obj["Ref"]]] = (obj["Ref"], None)
+            return {"Ref": PARENT_PARAMETERS[obj["Ref"]]}
+        if len(obj) == 1 and "Ref" in obj and owner.get(obj["Ref"], stack) != stack:
+            parameters[obj["Ref"]] = (obj["Ref"], None)
+            return {"Ref": obj["Ref"]}
+        if len(obj) == 1 and "Fn::GetAtt" in obj and owner.get(obj["Fn::GetAtt"][0], stack) != stack:
+            target, attribute = obj["Fn::GetAtt"]
+            parameter = re.sub(r'\W+', '', target + attribute)
+            parameters[parameter] = (target, attribute)
+            return {"Ref": parameter}
+        return dict((key, localise(obj[key], owner, stack, parameters)) for key in obj)
+    if isinstance(obj, list):
+        return [localise(item, owner, stack, parameters) for item in obj]
+    return obj
+
+
 class Environment(object):
 
     def exception(self, problem):
         '''base exception method'''
-        raise BaseExeption(problem)
-
-    def __init__(self, name, version="2010-09-09", description='A default environment', subnet_default=24):
-        '''Class for creating Amazon Cloudformation templates with minimal overhead'''
+        raise BaseException(problem)
+
+    def __init__(self, name, version="2010-09-09", description='A default environment', subnet_default=24, fragments="files", stats=None, output_dir=None):
+        '''Class for creating Amazon Cloudformation templates with minimal overhead.
+        fragments controls the per resource json output:
+            "files"    writes {name}/{Resource}.json as each resource is added
+            "deferred" keeps fragments in memory and writes the same files on flush_fragments
+            "ndjson"   writes every fragment to {name}.ndjson on flush_fragments
+            "archive"  writes every fragment to {name}.zip on flush_fragments
+            None       keeps no fragments
+        stats takes a stats.BuildStats to record time per add_* method, resource counts by
+        type, validation time and bytes written. Without one nothing is timed.
+        output_dir puts the fragments under output_dir instead of the working directory, so
+        environments built side by side never share files'''
+        if fragments not in FRAGMENT_MODES:
+            self.exception(
+                "fragments must be one of {}".format(FRAGMENT_MODES))
         self.version = version
         self.outputs = {}
         self.id = "a"
         self.count = 0
         self.name = name
-        self.dir = os.path.dirname(os.path.realpath(
-            __file__)) + '/{}'.format(self.name)
-        try:
-            os.stat(self.dir)
-        except OSError:
-            os.mkdir(self.dir)
-
+        self.fragments = fragments
+        self.stats = stats or NULL_STATS
+        if self.stats.enabled:
+            self.instrument()
+        self.pending_fragments = []
+        self.fragments_flushed = False
+        self.output = os.path.join(output_dir, name) if output_dir else name
+        if output_dir:
+            self.dir = os.path.abspath(self.output)
+        else:
+            self.dir = os.path.dirname(os.path.realpath(
+                __file__)) + '/{}'.format(self.name)
+        if self.fragments == "files":
+            try:
+                os.stat(self.dir)
+            except OSError:
+                os.makedirs(self.dir)
+
+        self.intrinsics = {}
         self.default_tags = [
             {"Key": "Application", "Value": self.cf_ref("AWS::StackName")}
         ]
         self.description = description
         self.default_network = False
         self.subnet_default = subnet_default
-        self.env = {
+        self.subnet_allocators = {}
+        self.header = {
             "AWSTemplateFormatVersion": self.version,
             "Description": self.description,
-            "Resources": {},
-            "Outputs": {},
             "Metadata": {"AWS::CloudFormation::Designer": {}}
         }
         self.inventory_order = []
         self.inventory = {}
+        self.inventory_by_type = {}
+        self.resources = {}
+        self.resource_order = []
+        self.output_order = []
+
+    def instrument(self):
+        '''Swaps this instance's add_* methods for timed ones, the class is left alone so
+        environments without stats pay nothing'''
+        for name in dir(self):
+            if name.startswith("add_"):
+                setattr(self, name, self.stats.timed(name, getattr(self, name)))
 
     def counter(self):
         '''Keeps track of the number of resources'''
@@ -53,40 +136,363 @@ class Environment(object):
 
     def get_first(self, _type):
         '''Gets first resources of type _type. Environment knows what order resources are added within the script so this will be the first resource created in the script'''
-        for resource in self.inventory_order:
-            if _type == resource[0]:
-                return resource[1]
-        return False
+        names = self.inventory_by_type.get(_type)
+        return names[0] if names else False
 
     def get_all(self, _type):
         '''Gets a list of all the resources of type _type.'''
-        return [resource[1] for resource in self.inventory_order if _type == resource[0]]
+        return list(self.inventory_by_type.get(_type, []))
+
+    def next_id(self):
+        '''Designer ids run a..z then aa, ab.. so large templates never run out of ids'''
+        chars = list(self.id)
+        i = len(chars) - 1
+        while i >= 0 and chars[i] == "z":
+            chars[i] = "a"
+            i -= 1
+        if i < 0:
+            chars.insert(0, "a")
+        else:
+            chars[i] = chr(ord(chars[i]) + 1)
+        return "".join(chars)
 
     def describe(self, *args):
         '''Returns a formatted string given arbitrary args'''
         description = '_'.join([str(arg) for arg in args])
         return re.sub(r'\W+', ' ', description)[:255:]
 
-    def show_resources(self):
-        '''Shows all the resources'''
-        return self.env
+    def template(self, materialize=True):
+        '''Builds the template dict from the stored resources and outputs. Without materialize
+        Resources maps each name to its TemplateResource, with the same key order'''
+        resources = {}
+        for name in self.resource_order:
+            resources[name] = self.resources[name].materialize(
+            ) if materialize else self.resources[name]
+        outputs = {}
+        for name in self.output_order:
+            outputs[name] = self.outputs[name].materialize()
+        return {
+            "AWSTemplateFormatVersion": self.header["AWSTemplateFormatVersion"],
+            "Description": self.header["Description"],
+            "Resources": resources,
+            "Outputs": outputs,
+            "Metadata": self.header["Metadata"]
+        }
 
-    def write_resources(self, filename):
-        '''Writes cloudformation object to file'''
+    @property
+    def env(self):
+        '''The whole template, as env was when resources were kept in it. It is a read only
+        snapshot, resources are changed through the add_* methods'''
+        return readonly(self.template())
+
+    def show_resources(self):
+        '''Shows all the resources, as a read only snapshot like env'''
+        return readonly(self.template())
+
+    def flush_fragments(self):
+        '''Writes out the fragments held back by the deferred, ndjson and archive modes in one go'''
+        pending, self.pending_fragments = self.pending_fragments, []
+        if not pending:
+            return 0
+        mode = "a" if self.fragments_flushed else "w"
+        self.fragments_flushed = True
+        written = 0
+        if self.fragments == "deferred":
+            if not os.path.isdir(self.output):
+                os.makedirs(self.output)
+            for name, resource in pending:
+                with open('{}/{}.json'.format(self.output, name), "w") as template:
+                    body = json.dumps(resource)
+                    template.write(body)
+                    written += len(body)
+        elif self.fragments == "ndjson":
+            with open('{}.ndjson'.format(self.output), mode) as fragments:
+                body = "".join(json.dumps({name: resource}) + "\n"
+                               for name, resource in pending)
+                fragments.write(body)
+                written += len(body)
+        elif self.fragments == "archive":
+            with zipfile.ZipFile('{}.zip'.format(self.output), mode, zipfile.ZIP_DEFLATED) as archive:
+                for name, resource in pending:
+                    body = json.dumps(resource)
+                    archive.writestr(
+                        '{}/{}.json'.format(self.name, name), body)
+                    written += len(body)
+        self.stats.count("bytes.fragments", written)
+        return len(pending)
+
+    def write_resources(self, filename, compact=False):
+        '''Streams the cloudformation object to file one resource at a time and returns a size
+        report with the total bytes, the bytes each resource takes and whether the template
+        is within the inline and S3 template limits'''
+        self.flush_fragments()
+        item_separator, key_separator = (
+            ',', ':') if compact else (', ', ': ')
+        encoder = json.JSONEncoder(
+            separators=(item_separator, key_separator))
+        template = self.template(materialize=False)
+        sizes = {}
+        total = 0
+        with open(filename, 'w+') as cf:
+            cf.write('{')
+            total += 1
+            for index, key in enumerate(template):
+                chunk = (item_separator if index else '') + \
+                    encoder.encode(key) + key_separator
+                cf.write(chunk)
+                total += len(chunk)
+                if key != "Resources":
+                    for chunk in encoder.iterencode(template[key]):
+                        cf.write(chunk)
+                        total += len(chunk)
+                    continue
+                cf.write('{')
+                total += 1
+                resources = template[key]
+                for position, name in enumerate(resources):
+                    size = 0
+                    chunk = (item_separator if position else '') + \
+                        encoder.encode(name) + key_separator
+                    cf.write(chunk)
+                    size += len(chunk)
+                    for chunk in encoder.iterencode(resources[name].materialize()):
+                        cf.write(chunk)
+                        size += len(chunk)
+                    sizes[name] = size
+                    total += size
+                cf.write('}')
+                total += 1
+            cf.write('}')
+            total += 1
+        self.stats.count("bytes.template", total)
+        self.template_size = {
+            "total": total,
+            "resources": sizes,
+            "inline": total <= CF_INLINE_LIMIT,
+            "s3": total <= CF_S3_LIMIT
+        }
+        if not self.template_size["s3"]:
+            print 'Template {} is {} bytes, over the {} byte S3 limit'.format(
+                filename, total, CF_S3_LIMIT)
+        return self.template_size
+
+    def shard(self, max_resources=100, by="type"):
+        '''Splits the template into a parent stack of AWS::CloudFormation::Stack resources and
+        the nested templates they point at. by="type" groups resources by service (EC2, IAM..)
+        and by="dependency" cuts the resources into runs in dependency order. References that
+        cross from one nested template to another become a Parameter on the consumer, an
+        Output on the provider and a Fn::GetAtt on the provider stack in the parent. Outputs
+        move into the nested template that owns what they reference and the parent re-exports
+        them with a Fn::GetAtt on that stack, so the parent keeps every Output it had.
+        Raises when the parent or a nested template would have more resources, parameters or
+        outputs than CloudFormation accepts.
+        Returns (parent, [(stack name, template), ..]), TemplateURLs are left for write_nested'''
+        if by not in ("type", "dependency"):
+            self.exception('by must be "type" or "dependency"')
+        template = self.show_resources()
+        resources = template["Resources"]
+        depends = self.dependency_graph().depends
+
+        order = [name for _type, name in self.inventory_order]
+        groups = []
+        if by == "type":
+            keys = {}
+            for name in order:
+                service = resources[name]["Type"].split("::")[1]
+                if service not in keys:
+                    keys[service] = len(groups)
+                    groups.append((service, []))
+                groups[keys[service]][1].append(name)
+        else:
+            groups.append(("Dependency", dependency_order(order, depends)))
+
+        owner = {}
+        shards = []
+        for service, names in groups:
+            for start in range(0, len(names), max_resources):
+                stack = "{}Stack{}".format(service.title(), start // max_resources + 1)
+                shards.append((stack, names[start:start + max_resources]))
+                for name in names[start:start + max_resources]:
+                    owner[name] = stack
+
+        children = []
+        imports = {}
+        exports = {}
+        stack_depends = {}
+        for stack, names in shards:
+            child_resources = {}
+            parameters = {}
+            for name in names:
+                resource = resources[name]
+                child = {}
+                for key in resource:
+                    if key == "Properties":
+                        child[key] = localise(resource[key], owner, stack, parameters)
+                    elif key == "DependsOn":
+                        local = [target for target in as_list(resource[key])
+                                 if owner.get(target, stack) == stack]
+                        for target in as_list(resource[key]):
+                            if owner.get(target, stack) != stack:
+                                stack_depends.setdefault(stack, set()).add(owner[target])
+                        if local:
+                            child[key] = local
+                    else:
+                        child[key] = resource[key]
+                child_resources[name] = child
+            imports[stack] = parameters
+            children.append((stack, {
+                "AWSTemplateFormatVersion": self.version,
+                "Description": "{} {}".format(self.description, stack),
+                "Parameters": {},
+                "Resources": child_resources,
+                "Outputs": {}
+            }))
+
+        parent_outputs = {}
+        templates = dict(children)
+        for name in template["Outputs"]:
+            output = template["Outputs"][name]
+            targets = [target for target, attribute in find_references(output["Value"])
+                       if target in owner]
+            if targets:
+                stack = owner[targets[0]]
+                moved = dict(output)
+                moved["Value"] = localise(output["Value"], owner, stack, imports[stack])
+                templates[stack]["Outputs"][name] = moved
+                parent_outputs[name] = {
+                    "Value": {"Fn::GetAtt": [stack, "Outputs." + name]},
+                    "Description": output.get("Description", "")
+                }
+            else:
+                parent_outputs[name] = output
+        for stack, child in children:
+            child["Parameters"] = {parameter: {"Type": "String"} for parameter in imports[stack]}
+            for parameter in imports[stack]:
+                target, attribute = imports[stack][parameter]
+                if target in PARENT_PARAMETERS:
+                    continue
+                exports.setdefault(owner[target], {})[parameter] = (target, attribute)
+        for stack in exports:
+            for parameter in exports[stack]:
+                target, attribute = exports[stack][parameter]
+                value = {"Fn::GetAtt": [target, attribute]} if attribute else {"Ref": target}
+                templates[stack]["Outputs"].setdefault(
+                    parameter, {"Value": value, "Description": ""})
+
+        for stack, child in children:
+            if len(child["Outputs"]) > CF_OUTPUT_LIMIT:
+                self.exception('{} has {} outputs, over the limit of {}, lower max_resources'.format(
+                    stack, len(child["Outputs"]), CF_OUTPUT_LIMIT))
+            if len(child["Parameters"]) > CF_PARAMETER_LIMIT:
+                self.exception('{} has {} parameters, over the limit of {}, lower max_resources'.format(
+                    stack, len(child["Parameters"]), CF_PARAMETER_LIMIT))
+            if len(child["Resources"]) > CF_RESOURCE_LIMIT:
+                self.exception('{} has {} resources, over the limit of {}, lower max_resources'.format(
+                    stack, len(child["Resources"]), CF_RESOURCE_LIMIT))
+        if len(shards) > CF_RESOURCE_LIMIT:
+            self.exception('The parent has {} nested stacks, over the limit of {}, raise max_resources'.format(
+                len(shards), CF_RESOURCE_LIMIT))
+        if len(parent_outputs) > CF_OUTPUT_LIMIT:
+            self.exception('The parent has {} outputs, over the limit of {}'.format(
+                len(parent_outputs), CF_OUTPUT_LIMIT))
+
+        parent_resources = {}
+        for stack, names in shards:
+            providers = set(imports[stack][parameter][0] for parameter in imports[stack]
+                            if imports[stack][parameter][0] not in PARENT_PARAMETERS)
+            requires = set(owner[target] for target in providers) | stack_depends.get(stack, set())
+            requires.discard(stack)
+            parent_resources[stack] = {
+                "Type": "AWS::CloudFormation::Stack",
+                "Properties": {}
+            }
+            if imports[stack]:
+                parent_resources[stack]["Properties"]["Parameters"] = dict(
+                    (parameter, self.nested_parameter(owner, parameter, imports[stack][parameter][0]))
+                    for parameter in imports[stack])
+            if requires:
+                parent_resources[stack]["DependsOn"] = sorted(requires)
+        cycle = find_cycle(dict((stack, parent_resources[stack].get("DependsOn", []))
+                                for stack in parent_resources))
+        if cycle:
+            self.exception('Nested stacks {} depend on each other, use by="dependency"'.format(
+                ' -> '.join(cycle)))
+        parent = {
+            "AWSTemplateFormatVersion": self.version,
+            "Description": self.description,
+            "Resources": parent_resources,
+            "Outputs": parent_outputs
+        }
+        return parent, children
+
+    @staticmethod
+    def nested_parameter(owner, parameter, target):
+        '''Value the parent passes to a nested stack parameter, its own AWS::StackName or
+        AWS::StackId, or the Output of the nested stack that owns target'''
+        if target in PARENT_PARAMETERS:
+            return {"Ref": target}
+        return {"Fn::GetAtt": [owner[target], "Outputs." + parameter]}
+
+    def write_nested(self, filename, url_prefix, max_resources=100, by="type"):
+        '''Writes the sharded parent template to filename and every nested template next to it as
+        {sha256}.json. Nested templates are written with sorted keys so unchanged ones keep the
+        same name, and so the same TemplateURL ({url_prefix}/{sha256}.json) in the parent, and
+        CloudFormation leaves those stacks alone on update. url_prefix is the bucket they are
+        uploaded to, amazon_client.bucket_url(bucket_name), and the Cloudformation deploying the
+        parent needs that bucket_name with content_addressed=True. Returns the nested template
+        paths, which go to Cloudformation as nested_templates'''
+        parent, children = self.shard(max_resources=max_resources, by=by)
+        directory = os.path.dirname(os.path.abspath(filename))
+        paths = []
+        for stack, child in children:
+            body = json.dumps(child, sort_keys=True)
+            key = hashlib.sha256(body).hexdigest() + ".json"
+            with open(os.path.join(directory, key), 'w') as template:
+                template.write(body)
+            paths.append(os.path.join(directory, key))
+            parent["Resources"][stack]["Properties"]["TemplateURL"] = "{}/{}".format(
+                url_prefix.rstrip('/'), key)
         with open(filename, 'w+') as cf:
-            cf.write(json.dumps(self.show_resources()))
+            cf.write(json.dumps(parent, sort_keys=True))
+        return paths
+
+    def dependency_graph(self):
+        '''DependencyGraph of the resources added so far, see graph.py. report() on it gives the
+        critical path depth and the DependsOn entries prune_depends would drop'''
+        return DependencyGraph([(name, self.resources[name].depends, self.resources[name].properties)
+                                for name in self.resource_order])
+
+    def prune_depends(self):
+        '''Drops DependsOn entries already implied by a Ref, a Fn::GetAtt or another dependency,
+        so the template only holds the edges that order anything. Raises graph.DependencyCycle
+        when resources depend on each other. Returns the dropped (resource, target) pairs'''
+        redundant = self.dependency_graph().redundant()
+        removed = {}
+        for name, target in redundant:
+            removed.setdefault(name, set()).add(target)
+        for name in removed:
+            resource = self.resources[name]
+            kept = []
+            for target in as_list(resource.depends):
+                if target not in removed[name] and target not in kept:
+                    kept.append(target)
+            if isinstance(resource.depends, list):
+                resource.depends = kept
+            else:
+                resource.depends = kept[0] if kept else None
+        return redundant
 
     def cf_ref(self, key):
         '''Cloudformation referential function'''
-        return {"Ref": key}
+        return intrinsic("Ref", key, self.intrinsics)
     
     def cf_get_at(self, resource, attribute):
         '''Cloudformation get at function'''
-        return { "Fn::GetAtt" : [resource, attribute] }
+        return intrinsic("Fn::GetAtt", [resource, attribute], self.intrinsics)
 
     def cf_designer(self, _id, source, target):
         '''Implements the Cloudformation Designer. This was used for debugging and hasn't been fully implemented'''
-        self.env["Metadata"]["AWS::CloudFormation::Designer"][_id] = {
+        self.header["Metadata"]["AWS::CloudFormation::Designer"][_id] = {
             "source": {
                 "id": self.inventory[source]
             },
@@ -98,34 +504,33 @@ class Environment(object):
 
     def cf_join(self, join_list, deliminator=""):
         '''Join function'''
-        return {"Fn::Join": [deliminator, join_list]}
+        return intrinsic("Fn::Join", [deliminator, join_list], self.intrinsics)
 
     def cf_availability_zones(self, zone):
         '''Availability zone function'''
-        return {"Fn::Select": [str(zone), {"Fn::GetAZs": {"Ref": "AWS::Region"}}]}
+        return intrinsic("Fn::Select", [str(zone), intrinsic("Fn::GetAZs", self.cf_ref("AWS::Region"), self.intrinsics)], self.intrinsics)
 
     def add_outputs(self, name, description='', target=None):
         '''Method to add output for resource'''
-        if not target:
-           self.env["Outputs"][name] = {
-               "Value": self.cf_ref(name),
-               "Description": description
-           }
-        else:
-           self.env["Outputs"][name] = {
-               "Value": target,
-               "Description": description
-           }
+        if name not in self.outputs:
+           self.output_order.append(name)
+        self.outputs[name] = TemplateOutput(
+            target if target else self.cf_ref(name), description)
           
 
+    def resource_name(self, name):
+        '''The logical id add_resource gives a resource called name'''
+        return name.replace(".", " ").title().replace(" ", "")
+
     def add_resource(self, name, _type, required, optional_keys, depends=None, outputs=None, **kwargs):
         '''Generic method for adding a resource to the Cloud formation template. Makes use of the Resource helper object'''
-        name = name.replace(".", " ").title().replace(" ", "")
+        name = self.resource_name(name)
         if outputs:
            for output in outputs:
               target = self.cf_get_at(name, output)
               self.add_outputs(name + output, target=target)
         self.add_outputs(name)
+        start = time.time() if self.stats.enabled else None
         if _type == "AWS::AutoScaling::AutoScalingGroup":
             temp_resource = Resource(_type,
                                      required,
@@ -154,19 +559,25 @@ class Environment(object):
                                      required,
                                      optional_keys,
                                      **kwargs)
+        if start:
+            self.stats.add_time("validation", time.time() - start)
+            self.stats.count("resources." + _type)
         self.inventory_order.append((_type, name))
+        self.inventory_by_type.setdefault(_type, []).append(name)
         self.inventory[name] = str(self.id)
-        self.env["Resources"][name] = temp_resource.return_resource()
-        if depends:
-            self.env["Resources"][name]["DependsOn"] = depends
-        self.env["Resources"][name]["Metadata"] = {
-            "AWS::CloudFormation::Designer": {
-                "id": str(self.id)
-            }
-        }
-        with open('{}/{}.json'.format(self.name, name), "w") as template:
-            template.write(json.dumps(temp_resource.return_resource()))
-        self.id = chr(ord(self.id) + 1)
+        if name not in self.resources:
+            self.resource_order.append(name)
+        self.resources[name] = TemplateResource(
+            _type, temp_resource.object, depends, str(self.id))
+        if self.fragments == "files":
+            with open('{}/{}.json'.format(self.output, name), "w") as template:
+                body = json.dumps(temp_resource.return_resource())
+                template.write(body)
+            self.stats.count("bytes.fragments", len(body))
+        elif self.fragments:
+            self.pending_fragments.append(
+                (name, temp_resource.return_resource()))
+        self.id = self.next_id()
 
     def add_vpc(self, name, cidr_block="192.168.0.0/16", **kwargs):
         required_keys = {"CidrBlock": str}
@@ -183,14 +594,21 @@ class Environment(object):
                           CidrBlock=cidr_block,
                           **kwargs)
 
+        self.subnet_allocators[self.resource_name(name)] = SubnetAllocator(
+            cidr_block, self.subnet_default)
         if not self.default_network:
+            import netaddr
             self.default_network = netaddr.IPNetwork(cidr_block)
-            self.network_generator = self.default_network.subnet(
-                self.subnet_default)
 
-    def add_subnet(self, name, vpc=None, cidr_block=None, **kwargs):
+    def add_subnet(self, name, vpc=None, cidr_block=None, prefix=None, **kwargs):
+        '''Adds a subnet to vpc (the first VPC by default). Without cidr_block the next free
+        block of prefix (subnet_default by default) is allocated from the VPC, an explicit
+        cidr_block is reserved so it is never handed out twice'''
         vpc = self.get_first("AWS::EC2::VPC") if not vpc else vpc
-        cidr_block = self.get_next_subnet() if not cidr_block else cidr_block
+        if not cidr_block:
+            cidr_block = self.get_next_subnet(vpc, prefix)
+        elif vpc in self.subnet_allocators:
+            self.subnet_allocators[vpc].reserve(cidr_block)
         required_keys = {
             "CidrBlock": str,
             "VpcId": dict
@@ -237,9 +655,16 @@ class Environment(object):
                           VpcId=vpc_ref,
                           InternetGatewayId=gateway_ref)
 
-    def get_next_subnet(self):
-        if self.default_network:
-            return str(self.network_generator.next())
+    def get_next_subnet(self, vpc=None, prefix=None):
+        '''Allocates the next free block of prefix from vpc, both defaulting to the first VPC and subnet_default'''
+        vpc = self.get_first("AWS::EC2::VPC") if not vpc else vpc
+        if vpc in self.subnet_allocators:
+            return self.subnet_allocators[vpc].allocate(prefix)
+
+    def release_subnet(self, cidr_block, vpc=None):
+        '''Hands a block back to the VPC's allocator so it can be allocated again'''
+        vpc = self.get_first("AWS::EC2::VPC") if not vpc else vpc
+        self.subnet_allocators[vpc].release(cidr_block)
 
     def add_route_table(self, name, vpc=None, attached=None):
         vpc = self.cf_ref(self.get_first("AWS::EC2::VPC")
@@ -1,13 +1,80 @@
 import os
-import boto3
+import json
+import re
 import string
 import random
+import hashlib
 import datetime
+import threading
+import time
+import Queue
 from pprint import pprint
-from fabric.api import local
+from botocore.exceptions import ClientError, ConnectionError, HTTPClientError, WaiterError
+from stats import NULL_STATS
 
-if 'martyn' in os.environ.get('VIRTUAL_ENV', ''):
-    boto3 = boto3.Session(profile_name='martyn', region_name='eu-west-1')
+boto3 = None
+
+DEFAULT_POOL_CONNECTIONS = 10
+MULTIPART_THRESHOLD = 8 * 1024 * 1024
+BUCKET_TAG = 'StackName'
+DELETE_BATCH = 1000
+DEFAULT_RETRIES = {'max_attempts': 5, 'mode': 'standard'}
+# error codes that only mean try again later
+TRANSIENT_ERRORS = frozenset([
+    'Throttling', 'ThrottlingException', 'RequestLimitExceeded', 'TooManyRequestsException',
+    'ServiceUnavailable', 'InternalFailure', 'InternalError', 'RequestTimeout',
+    'RequestTimeoutException'
+])
+SESSIONS = {}
+CLIENTS = {}
+CLIENT_LOCK = threading.Lock()
+
+
+def default_profile():
+    '''The martyn profile inside a virtualenv with martyn in its path, otherwise boto3's default'''
+    if 'martyn' in os.environ.get('VIRTUAL_ENV', ''):
+        return 'martyn'
+    return None
+
+
+def get_session(region=None, profile=None):
+    '''One boto3 Session per (region, profile), created on first use. boto3 itself is only
+    imported here, so code that never talks to AWS never loads it'''
+    profile = profile or default_profile()
+    key = (region, profile)
+    global boto3
+    with CLIENT_LOCK:
+        if boto3 is None:
+            import boto3
+        if key not in SESSIONS:
+            SESSIONS[key] = boto3.Session(profile_name=profile, region_name=region)
+        return SESSIONS[key]
+
+
+def get_client(service, region=None, profile=None, endpoint_url=None, max_pool_connections=None, retries=None, cached=True):
+    '''A boto3 client shared by everything in the process asking for the same service, region,
+    profile, endpoint and settings, so their connection pools are reused. Clients are thread
+    safe once created and creation is serialised, so concurrent deployments can share them.
+    max_pool_connections and retries ({'max_attempts': .., 'mode': ..}) default to
+    DEFAULT_POOL_CONNECTIONS and DEFAULT_RETRIES. cached=False always makes a new client'''
+    max_pool_connections = max_pool_connections or DEFAULT_POOL_CONNECTIONS
+    retries = retries or DEFAULT_RETRIES
+    session = get_session(region, profile)
+    key = (service, region, profile or default_profile(), endpoint_url,
+           max_pool_connections, tuple(sorted(retries.items())))
+    with CLIENT_LOCK:
+        if cached and key in CLIENTS:
+            return CLIENTS[key]
+        from botocore.config import Config
+        client = session.client(
+            service,
+            endpoint_url=endpoint_url,
+            config=Config(max_pool_connections=max_pool_connections,
+                          retries=dict(retries))
+        )
+        if cached:
+            CLIENTS[key] = client
+        return client
 
 
 def random_str(size=6, chars=string.ascii_lowercase):
@@ -22,56 +89,774 @@ def date_str():
     return date_str
 
 
+def file_digest(filename, chunk_size=1024 * 1024):
+    '''sha256 of a file, read in chunks so large templates are never held in memory'''
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as source:
+        for chunk in iter(lambda: source.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def bucket_url(bucket_name, endpoint_url=None):
+    '''Where CloudFormation fetches templates in bucket_name from, the url_prefix for
+    Environment.write_nested'''
+    return "{}/{}".format(endpoint_url or "https://s3.amazonaws.com", bucket_name)
+
+
+def nested_template_urls(filename):
+    '''TemplateURL of every nested stack in the template in filename'''
+    with open(filename) as template:
+        resources = json.load(template).get("Resources", {})
+    return [resources[name]["Properties"]["TemplateURL"] for name in sorted(resources)
+            if resources[name].get("Type") == "AWS::CloudFormation::Stack"
+            and "TemplateURL" in resources[name].get("Properties", {})]
+
+
+def artifact_keys(paths, prefix=""):
+    '''(file, key) for every file in paths, directories are walked and their files keyed by
+    their path below the directory's parent, so fragments in my_env/ land in {prefix}my_env/'''
+    for path in paths:
+        if isinstance(path, tuple):
+            yield path
+        elif os.path.isdir(path):
+            parent = os.path.dirname(os.path.abspath(path))
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for name in sorted(files):
+                    filename = os.path.join(root, name)
+                    yield filename, prefix + os.path.relpath(
+                        os.path.abspath(filename), parent).replace(os.sep, '/')
+        else:
+            yield path, prefix + os.path.basename(path)
+
+
+def run_concurrently(function, items, max_workers):
+    '''function(item) for every item, max_workers threads at a time, results in item order.
+    function should catch its own errors, anything it raises is lost with its thread'''
+    results = [None] * len(items)
+    pending = Queue.Queue()
+    for index, item in enumerate(items):
+        pending.put((index, item))
+
+    def worker():
+        while True:
+            try:
+                index, item = pending.get_nowait()
+            except Queue.Empty:
+                return
+            results[index] = function(item)
+
+    workers = [threading.Thread(target=worker) for _ in range(min(max_workers, len(items)))]
+    for thread in workers:
+        thread.daemon = True
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return results
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def not_found(error):
+    return error.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NoSuchBucket', 'NotFound')
+
+
+def transient(error):
+    '''True for throttling, server side and connection errors, which are worth retrying'''
+    if isinstance(error, ClientError):
+        return error.response.get('Error', {}).get('Code') in TRANSIENT_ERRORS
+    return isinstance(error, (ConnectionError, HTTPClientError))
+
+
+class StackError(BaseException):
+    pass
+
+
+class StackOperation(object):
+    '''Handle on a stack create/update driven by a StackPoller. Wait on it with result(),
+    check it with done() and status, or stop it with cancel()'''
+
+    def __init__(self, client, name, success, failure, cancel=None):
+        self.client = client
+        self.name = name
+        self.success = success
+        self.failure = failure
+        self.canceller = cancel
+        self.status = None
+        self.cancelled = False
+        self.error = None
+        self.finished = threading.Event()
+
+    def update(self, status):
+        '''Records a polled status, returns True once the operation has finished'''
+        self.status = status
+        if status in self.success:
+            self.finish()
+        elif status in self.failure:
+            self.finish(StackError('{} finished in {}'.format(self.name, status)))
+        return self.done()
+
+    def finish(self, error=None):
+        self.error = error
+        self.finished.set()
+
+    def done(self):
+        return self.finished.is_set()
+
+    def result(self, timeout=None):
+        '''Blocks until the operation finishes and returns its final status, raising StackError if it failed'''
+        if not self.finished.wait(timeout):
+            raise StackError('{} still in {} after {}s'.format(
+                self.name, self.status, timeout))
+        if self.error:
+            raise self.error
+        return self.status
+
+    def cancel(self):
+        '''Asks CloudFormation to stop the operation, the poller then sees it through to its final state'''
+        if self.done() or not self.canceller:
+            return False
+        self.cancelled = True
+        self.canceller()
+        return True
+
+
+class StackPoller(object):
+    '''A single thread polling every outstanding StackOperation. The interval drops back to
+    min_interval whenever a status changes and grows by backoff up to max_interval while
+    nothing does'''
+
+    def __init__(self, min_interval=2, max_interval=30, backoff=1.5):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.operations = []
+        self.condition = threading.Condition()
+        self.thread = None
+
+    def watch(self, operation):
+        with self.condition:
+            self.operations.append(operation)
+            if not self.thread or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run)
+                self.thread.daemon = True
+                self.thread.start()
+            self.condition.notify()
+        return operation
+
+    def poll(self, operations):
+        '''Updates each operation from a describe_stacks of its own stack, so a tick costs one
+        call per watched stack however many stacks the account has. A transient error leaves
+        the operation, and the rest on the same client, to the next tick, anything else fails
+        the operation'''
+        throttled = []
+        for operation in operations:
+            if any(client is operation.client for client in throttled):
+                continue
+            try:
+                status = self.describe(operation.client, operation.name)
+            except Exception as error:
+                if transient(error):
+                    throttled.append(operation.client)
+                else:
+                    operation.finish(error)
+                continue
+            operation.update(status)
+
+    @staticmethod
+    def describe(client, name):
+        try:
+            return client.describe_stacks(StackName=name)["Stacks"][0]["StackStatus"]
+        except ClientError as error:
+            if 'does not exist' in str(error):
+                return 'DELETE_COMPLETE'
+            raise
+
+    def next_interval(self, interval, changed):
+        return self.min_interval if changed else min(interval * self.backoff, self.max_interval)
+
+    def run(self):
+        interval = self.min_interval
+        while True:
+            with self.condition:
+                if not self.operations:
+                    self.thread = None
+                    return
+                operations = list(self.operations)
+            previous = [operation.status for operation in operations]
+            self.poll([operation for operation in operations if not operation.done()])
+            changed = False
+            for operation, status in zip(operations, previous):
+                if operation.done():
+                    changed = True
+                    with self.condition:
+                        self.operations.remove(operation)
+                elif operation.status != status:
+                    changed = True
+            interval = self.next_interval(interval, changed)
+            with self.condition:
+                if self.operations:
+                    self.condition.wait(interval)
+
+
+POLLER = None
+
+
+def default_poller():
+    '''The poller shared by every Cloudformation in the process, created on first use'''
+    global POLLER
+    if POLLER is None:
+        POLLER = StackPoller()
+    return POLLER
+
+
+CREATE_SUCCESS = ('CREATE_COMPLETE',)
+CREATE_FAILURE = ('CREATE_FAILED', 'ROLLBACK_COMPLETE', 'ROLLBACK_FAILED',
+                  'DELETE_COMPLETE', 'DELETE_FAILED')
+EVENT_FAILURE = ('CREATE_FAILED', 'UPDATE_FAILED')
+STACK_FAILURE = ('ROLLBACK_IN_PROGRESS', 'ROLLBACK_COMPLETE', 'ROLLBACK_FAILED',
+                 'UPDATE_ROLLBACK_IN_PROGRESS', 'UPDATE_ROLLBACK_COMPLETE',
+                 'UPDATE_ROLLBACK_FAILED', 'CREATE_FAILED', 'DELETE_COMPLETE',
+                 'DELETE_FAILED')
+STACK_SUCCESS = ('CREATE_COMPLETE', 'UPDATE_COMPLETE')
+
+
+def format_event(event):
+    return '{} {:<40} {:<30} {}'.format(
+        event.get("Timestamp", ""),
+        event["LogicalResourceId"],
+        event["ResourceStatus"],
+        event.get("ResourceStatusReason", "")
+    )
+
+
 class Cloudformation(object):
 
-    def __init__(self, name, filename, region='eu-west-1', bucket_name='cloudformation', on_failure='DELETE', randomize_bucket=True):
-        self.cf = boto3.client('cloudformation')
-        self.s3 = boto3.client('s3')
+    def __init__(self, name, filename, region=None, bucket_name='cloudformation', on_failure='DELETE', randomize_bucket=True, content_addressed=False, endpoint_url=None, nested_templates=(), stats=None, profile=None, max_pool_connections=None, retries=None, artifacts=()):
+        '''content_addressed keeps templates in bucket_name as is, keyed by the sha256 of their
+        content, and skips the upload when that key already exists. endpoint_url points the
+        s3 client at a local stand in. nested_templates, as written by Environment.write_nested,
+        are always uploaded content addressed so only the ones that changed are sent. Their
+        URLs are baked into the parent template, so they need content_addressed, which keeps
+        bucket_name as is, and the parent's TemplateURLs must start with bucket_url(bucket_name).
+        stats takes a stats.BuildStats to record the latency of every boto3 call.
+        Clients come from get_client, shared with every other Cloudformation using the same
+        region, profile and settings, apart from instances with stats, which get their own
+        so the timings only cover their calls.
+        region defaults to the one configured for the profile, AWS_DEFAULT_REGION or
+        ~/.aws/config, like any other boto3 client.
+        artifacts are files or directories, like an Environment's fragment directory, that are
+        uploaded alongside the template under {name}/ by upload_files.
+        Nothing is created or uploaded here, upload_to_s3 runs on the first stack_request, so
+        an update that turns out to have nothing to change never touches S3'''
+        if nested_templates and not content_addressed:
+            raise StackError('nested_templates need content_addressed=True, a randomized bucket '
+                             'would not match the TemplateURLs in {}'.format(filename))
+        self.stats = stats or NULL_STATS
+        options = {
+            'region': region,
+            'profile': profile,
+            'max_pool_connections': max_pool_connections,
+            'retries': retries,
+            'cached': not self.stats.enabled
+        }
+        self.client_options = options
+        self.cf = get_client('cloudformation', **options)
+        self.s3 = get_client('s3', endpoint_url=endpoint_url, **options)
+        if self.stats.enabled:
+            self.instrument(self.cf)
+            self.instrument(self.s3)
         self.name = name
-        self.region = region
-        if randomize_bucket:
+        self.region = self.s3.meta.region_name
+        self.endpoint_url = endpoint_url
+        self.content_addressed = content_addressed
+        self.randomized = randomize_bucket and not content_addressed
+        if self.randomized:
             self.bucket_name = bucket_name + date_str()
         else:
             self.bucket_name = bucket_name
         self.filename = filename
+        self.key = filename
+        self.nested_templates = nested_templates
+        self.artifacts = artifacts
         self.on_failure = on_failure
-        self.upload_to_s3()
+        self.uploaded = False
+
+    def instrument(self, client):
+        '''Times every API call the client makes through botocore's before/after-call events'''
+        def before_call(context, **kwargs):
+            context['stats_start'] = time.time()
+
+        def after_call(context, event_name, **kwargs):
+            if 'stats_start' in context:
+                self.stats.add_time(
+                    'boto3.' + event_name.split('.', 1)[1],
+                    time.time() - context.pop('stats_start'))
+
+        client.meta.events.register('before-call', before_call)
+        client.meta.events.register('after-call', after_call)
+
+    def grow_s3_pool(self, connections):
+        '''Swaps self.s3 for a client with the same settings and a pool of connections, when
+        its own pool is smaller, so concurrent transfers never wait for a free connection'''
+        if self.s3.meta.config.max_pool_connections >= connections:
+            return
+        options = dict(self.client_options, max_pool_connections=connections)
+        self.s3 = get_client('s3', endpoint_url=self.endpoint_url, **options)
+        if self.stats.enabled:
+            self.instrument(self.s3)
+
+    def bucket_exists(self):
+        try:
+            self.s3.head_bucket(Bucket=self.bucket_name)
+        except ClientError as error:
+            if not_found(error):
+                return False
+            raise
+        return True
+
+    def object_exists(self, key):
+        try:
+            self.s3.head_object(Bucket=self.bucket_name, Key=key)
+        except ClientError as error:
+            if not_found(error):
+                return False
+            raise
+        return True
 
     def create_bucket(self, **kwargs):
+        '''Creates the bucket, unless a bucket_name that is not randomized already exists,
+        which outside us-east-1 create_bucket refuses with BucketAlreadyOwnedByYou'''
+        if not self.randomized and self.bucket_exists():
+            return
         print 'Creating : {}'.format(self.bucket_name)
-        self.s3.create_bucket(Bucket=self.bucket_name)
+        region = self.s3.meta.region_name
+        if region and region != 'us-east-1':
+            self.s3.create_bucket(Bucket=self.bucket_name, CreateBucketConfiguration={
+                'LocationConstraint': region})
+        else:
+            self.s3.create_bucket(Bucket=self.bucket_name)
+        if self.randomized:
+            self.tag_bucket()
 
-    def upload_to_s3(self, **kwargs):
-        self.create_bucket()
-        obj = {
-            'Body': open(self.filename, 'r'),
-            'Key': self.filename,
-            'Bucket': self.bucket_name
-        }
+    def tag_bucket(self):
+        '''Records the stack a randomized bucket was made for, which cleanup_buckets reads to
+        leave the newest bucket of every live stack alone'''
+        self.s3.put_bucket_tagging(Bucket=self.bucket_name, Tagging={
+            'TagSet': [{'Key': BUCKET_TAG, 'Value': self.name}]})
+
+    def upload_file(self, filename, key):
         print 'Uploading {} to {}'.format(
-            self.filename,
+            filename,
             self.bucket_name
         )
-        self.s3.put_object(**obj)
+        with open(filename, 'rb') as body:
+            self.s3.put_object(Body=body, Key=key,
+                               Bucket=self.bucket_name)
 
-    def create_stack(self):
-        self.url = "https://s3.amazonaws.com/{}/{}".format(
-            self.bucket_name,
-            self.filename
-        )
-        obj = {
+    def upload_files(self, files, prefix="", content_addressed=False, max_workers=8, multipart_threshold=MULTIPART_THRESHOLD, multipart_concurrency=4):
+        '''Uploads files, paths, directories or (path, key) pairs, max_workers at a time
+        through the S3 transfer manager, which splits files over multipart_threshold into
+        parts sent multipart_concurrency at a time, on an s3 client with a connection for every
+        part in flight, see grow_s3_pool. content_addressed keys every file by its
+        sha256 and skips those already in the bucket. Returns a report with the latency of
+        every file and the overall throughput. Raises the first failure once every other
+        upload has finished'''
+        from boto3.s3.transfer import TransferConfig
+        config = TransferConfig(multipart_threshold=multipart_threshold,
+                                max_concurrency=multipart_concurrency)
+        if content_addressed:
+            jobs = [(path, prefix + file_digest(path) + os.path.splitext(path)[1])
+                    for path, key in artifact_keys(files)]
+        else:
+            jobs = list(artifact_keys(files, prefix))
+        self.grow_s3_pool(min(max_workers, len(jobs)) * multipart_concurrency)
+
+        def upload(job):
+            filename, key = job
+            start = time.time()
+            result = {"file": filename, "key": key, "bytes": 0, "skipped": False, "error": None}
+            try:
+                result["bytes"] = os.path.getsize(filename)
+                if content_addressed and self.object_exists(key):
+                    result["skipped"] = True
+                else:
+                    self.s3.upload_file(filename, self.bucket_name, key, Config=config)
+            except Exception as error:
+                result["error"] = error
+            result["seconds"] = time.time() - start
+            return result
+
+        start = time.time()
+        results = run_concurrently(upload, jobs, max_workers)
+        elapsed = time.time() - start
+        sent = [result for result in results if not result["skipped"] and not result["error"]]
+        latencies = [result["seconds"] for result in results]
+        report = {
+            "files": results,
+            "uploaded": len(sent),
+            "skipped": len([result for result in results if result["skipped"]]),
+            "bytes": sum(result["bytes"] for result in sent),
+            "seconds": elapsed,
+            "bytes_per_second": sum(result["bytes"] for result in sent) / elapsed if elapsed else 0.0,
+            "latency": {
+                "p50": percentile(latencies, 0.5),
+                "p95": percentile(latencies, 0.95),
+                "max": max(latencies) if latencies else 0.0
+            }
+        }
+        for result in results:
+            self.stats.add_time("upload", result["seconds"])
+        self.stats.count("bytes.uploaded", report["bytes"])
+        if jobs:
+            print 'Uploaded {} of {} files to {}, {} bytes in {:.2f}s ({:.1f} MB/s), latency p50 {:.3f}s p95 {:.3f}s max {:.3f}s'.format(
+                report["uploaded"], len(jobs), self.bucket_name, report["bytes"], elapsed,
+                report["bytes_per_second"] / 1e6, report["latency"]["p50"],
+                report["latency"]["p95"], report["latency"]["max"])
+        for result in results:
+            if result["error"]:
+                raise result["error"]
+        return report
+
+    def bucket_url(self):
+        return bucket_url(self.bucket_name, self.endpoint_url)
+
+    def check_nested(self):
+        '''Raises StackError if the parent template points at nested templates anywhere but
+        the bucket they are uploaded to'''
+        prefix = self.bucket_url() + "/"
+        elsewhere = [url for url in nested_template_urls(self.filename)
+                     if not url.startswith(prefix)]
+        if elsewhere:
+            raise StackError('{} has nested templates outside {}: {}'.format(
+                self.filename, prefix, ', '.join(elsewhere)))
+
+    def upload_nested(self):
+        return self.upload_files(self.nested_templates, content_addressed=True)
+
+    def upload_artifacts(self):
+        return self.upload_files(self.artifacts, prefix=self.name + "/")
+
+    def upload_to_s3(self, **kwargs):
+        if self.nested_templates:
+            self.check_nested()
+        self.create_bucket()
+        self.upload_nested()
+        self.upload_artifacts()
+        if self.content_addressed:
+            self.key = file_digest(self.filename) + \
+                os.path.splitext(self.filename)[1]
+            if self.object_exists(self.key):
+                print '{} unchanged, already in {} as {}'.format(
+                    self.filename,
+                    self.bucket_name,
+                    self.key
+                )
+                self.uploaded = True
+                return
+        self.upload_file(self.filename, self.key)
+        self.uploaded = True
+
+    def stack_request(self):
+        if not self.uploaded:
+            self.upload_to_s3()
+        self.url = "{}/{}".format(self.bucket_url(), self.key)
+        return {
             'StackName': self.name,
             'TemplateURL': self.url,
             'Capabilities': ['CAPABILITY_NAMED_IAM'],
             'OnFailure': self.on_failure
         }
+
+    def create_stack_async(self, poller=None):
+        '''Starts the create and returns a StackOperation straight away instead of waiting.
+        Every operation shares one poller, so many stacks can be driven from one thread'''
+        obj = self.stack_request()
         pprint(obj)
         self.cf.create_stack(**obj)
+        operation = StackOperation(
+            self.cf,
+            self.name,
+            CREATE_SUCCESS,
+            CREATE_FAILURE,
+            cancel=lambda: self.cf.delete_stack(StackName=self.name)
+        )
+        return (poller or default_poller()).watch(operation)
+
+    def create_stack(self, tail=True):
+        '''Creates the stack and prints its events as they happen, raising StackError as soon
+        as a resource fails. tail=False waits on the stack_create_complete waiter instead'''
+        obj = self.stack_request()
+        pprint(obj)
+        self.cf.create_stack(**obj)
+        if tail:
+            for event in self.tail_events():
+                print format_event(event)
+            return
         self.waiter = self.cf.get_waiter('stack_create_complete')
         print 'Creating stack',
         self.waiter.wait(StackName=self.name)
         print 'Done'
 
+    def latest_event_id(self):
+        '''EventId of the newest event on the stack, pass it as after= to tail an update'''
+        events = self.cf.describe_stack_events(StackName=self.name)["StackEvents"]
+        return events[0]["EventId"] if events else None
+
+    def new_events(self, seen, after):
+        '''Events not in seen, oldest first. describe_stack_events pages newest first, so
+        paging stops at the first event already seen or at after. New events arriving while
+        paging shift the pages, so an event can come back on the next page and is skipped'''
+        events = []
+        batch = set()
+        kwargs = {'StackName': self.name}
+        while True:
+            response = self.cf.describe_stack_events(**kwargs)
+            for event in response["StackEvents"]:
+                if event["EventId"] in seen or event["EventId"] == after:
+                    return events[::-1]
+                if event["EventId"] in batch:
+                    continue
+                batch.add(event["EventId"])
+                events.append(event)
+            if not response.get("NextToken"):
+                return events[::-1]
+            kwargs['NextToken'] = response["NextToken"]
+
+    def tail_events(self, after=None, fail_fast=True, min_interval=2, max_interval=30, backoff=1.5, timeout=None):
+        '''Yields the stack's events oldest first as they arrive, until the stack reaches a
+        final status. Events up to and including the EventId after are skipped. The poll
+        interval drops back to min_interval whenever something new shows up and grows by
+        backoff up to max_interval while nothing does. A failed stack, or with fail_fast the
+        first resource that fails to create or update, raises StackError straight after its
+        event, since the outcome is settled from then on and the rollback only undoes work'''
+        seen = set()
+        interval = min_interval
+        deadline = time.time() + timeout if timeout else None
+        while True:
+            try:
+                events = self.new_events(seen, after)
+            except ClientError as error:
+                if 'does not exist' in str(error):
+                    raise StackError('{} no longer exists'.format(self.name))
+                raise
+            for event in events:
+                seen.add(event["EventId"])
+                yield event
+                status = event["ResourceStatus"]
+                if event["LogicalResourceId"] == self.name and \
+                        event.get("ResourceType") == "AWS::CloudFormation::Stack":
+                    if status in STACK_SUCCESS:
+                        return
+                    if status in STACK_FAILURE and (fail_fast or not status.endswith('_IN_PROGRESS')):
+                        raise StackError('{} finished in {}'.format(self.name, status))
+                elif fail_fast and status in EVENT_FAILURE:
+                    raise StackError('{} {}: {}'.format(
+                        event["LogicalResourceId"], status,
+                        event.get("ResourceStatusReason", "")))
+            if deadline and time.time() > deadline:
+                raise StackError('{} still running after {}s'.format(self.name, timeout))
+            interval = min_interval if events else min(interval * backoff, max_interval)
+            time.sleep(interval)
+
+    def stack_exists(self):
+        try:
+            self.cf.describe_stacks(StackName=self.name)
+        except ClientError as error:
+            if 'does not exist' in str(error):
+                return False
+            raise
+        return True
+
+    def local_template(self):
+        with open(self.filename) as template:
+            return json.load(template)
+
+    def deployed_template(self):
+        body = self.cf.get_template(StackName=self.name)["TemplateBody"]
+        return json.loads(body) if isinstance(body, basestring) else body
+
+    def describe_changes(self, change_set):
+        '''Sorts the resource changes of a change set into added, modified, replaced and removed,
+        with "conditional" for modifications that may or may not replace the resource'''
+        summary = {
+            "changed": True,
+            "change_set": change_set,
+            "add": [],
+            "modify": [],
+            "replace": [],
+            "conditional": [],
+            "remove": []
+        }
+        kwargs = {'StackName': self.name, 'ChangeSetName': change_set}
+        while True:
+            response = self.cf.describe_change_set(**kwargs)
+            for change in response.get("Changes", []):
+                resource = change["ResourceChange"]
+                action = resource["Action"]
+                replacement = resource.get("Replacement")
+                if action == "Add":
+                    key = "add"
+                elif action == "Remove":
+                    key = "remove"
+                elif replacement == "True":
+                    key = "replace"
+                elif replacement == "Conditional":
+                    key = "conditional"
+                else:
+                    key = "modify"
+                summary[key].append(resource["LogicalResourceId"])
+            if not response.get("NextToken"):
+                return summary
+            kwargs['NextToken'] = response["NextToken"]
+
+    def update_stack(self, execute=True):
+        '''Updates an existing stack through a change set and returns describe_changes' summary.
+        When the template matches the deployed one nothing is uploaded or sent to
+        CloudFormation. Only the template body is compared: stack_request sends no Parameters
+        or Tags, so an update always keeps the stack's existing ones and they cannot differ'''
+        unchanged = {"changed": False, "change_set": None, "add": [], "modify": [],
+                     "replace": [], "conditional": [], "remove": []}
+        if self.local_template() == self.deployed_template():
+            print 'No changes to {}'.format(self.name)
+            return unchanged
+        obj = self.stack_request()
+        del obj['OnFailure']
+        obj['ChangeSetName'] = '{}-{}'.format(self.name, date_str())
+        obj['ChangeSetType'] = 'UPDATE'
+        self.cf.create_change_set(**obj)
+        try:
+            self.cf.get_waiter('change_set_create_complete').wait(
+                StackName=self.name, ChangeSetName=obj['ChangeSetName'])
+        except WaiterError:
+            reason = self.cf.describe_change_set(
+                StackName=self.name,
+                ChangeSetName=obj['ChangeSetName']
+            ).get("StatusReason", "")
+            if "didn't contain changes" not in reason and "No updates" not in reason:
+                raise StackError(reason)
+            self.cf.delete_change_set(
+                StackName=self.name, ChangeSetName=obj['ChangeSetName'])
+            print 'No changes to {}'.format(self.name)
+            return unchanged
+        summary = self.describe_changes(obj['ChangeSetName'])
+        pprint(summary)
+        if execute:
+            after = self.latest_event_id()
+            self.cf.execute_change_set(
+                StackName=self.name, ChangeSetName=obj['ChangeSetName'])
+            for event in self.tail_events(after=after):
+                print format_event(event)
+        return summary
+
+    def deploy(self):
+        '''Creates the stack, or updates it through a change set when it already exists'''
+        if self.stack_exists():
+            return self.update_stack()
+        self.create_stack()
+
+def live_stacks(cf):
+    '''Names of every stack that still exists'''
+    names = set()
+    for page in cf.get_paginator('describe_stacks').paginate():
+        for stack in page["Stacks"]:
+            if stack["StackStatus"] != 'DELETE_COMPLETE':
+                names.add(stack["StackName"])
+    return names
+
+
+def bucket_stack(s3, bucket):
+    '''The stack in bucket's StackName tag, None for an untagged bucket'''
+    try:
+        tags = s3.get_bucket_tagging(Bucket=bucket)["TagSet"]
+    except ClientError as error:
+        if error.response.get('Error', {}).get('Code') == 'NoSuchTagSet':
+            return None
+        raise
+    for tag in tags:
+        if tag["Key"] == BUCKET_TAG:
+            return tag["Value"]
+    return None
+
+
+def empty_and_delete_bucket(s3, bucket):
+    '''Deletes every object in bucket, a page of up to DELETE_BATCH keys per delete_objects
+    call, then the bucket itself. Returns the number of objects deleted'''
+    deleted = 0
+    for page in s3.get_paginator('list_objects_v2').paginate(
+            Bucket=bucket, PaginationConfig={'PageSize': DELETE_BATCH}):
+        keys = [{'Key': item["Key"]} for item in page.get("Contents", [])]
+        for start in range(0, len(keys), DELETE_BATCH):
+            batch = keys[start:start + DELETE_BATCH]
+            response = s3.delete_objects(Bucket=bucket, Delete={'Objects': batch, 'Quiet': True})
+            errors = response.get("Errors", [])
+            if errors:
+                raise StackError('{} of {} objects in {} not deleted, first: {} {}'.format(
+                    len(errors), len(batch), bucket, errors[0].get("Key"), errors[0].get("Message")))
+            deleted += len(batch)
+    s3.delete_bucket(Bucket=bucket)
+    return deleted
+
+
+def cleanup_buckets(prefix='cloudformation', keep=5, max_workers=4, dry_run=False, region=None, profile=None, endpoint_url=None):
+    '''Deletes the template buckets Cloudformation(randomize_bucket=True) leaves behind: those
+    named prefix followed by a date_str() timestamp. The keep newest by CreationDate are left,
+    as is the newest bucket tagged with each live stack's name, see Cloudformation.tag_bucket,
+    and any bucket whose tags cannot be read. The rest are emptied and deleted, max_workers
+    buckets at a time. dry_run only reports what would go.
+    Returns {"kept": [..], "referenced": [..], "deleted": [{"bucket", "objects", "seconds",
+    "error"}, ..]}'''
+    s3 = get_client('s3', region=region, profile=profile, endpoint_url=endpoint_url,
+                    max_pool_connections=max(max_workers, DEFAULT_POOL_CONNECTIONS))
+    cf = get_client('cloudformation', region=region, profile=profile)
+    pattern = re.compile(re.escape(prefix) + r'\d{14,}$')
+    buckets = sorted((bucket for bucket in s3.list_buckets()["Buckets"]
+                      if pattern.match(bucket["Name"])),
+                     key=lambda bucket: bucket["CreationDate"], reverse=True)
+    names = [bucket["Name"] for bucket in buckets]
+    live = live_stacks(cf)
+
+    def owner(bucket):
+        try:
+            return bucket_stack(s3, bucket), True
+        except ClientError:
+            return None, False
+
+    newest = set()
+    referenced = set()
+    for bucket, (stack, readable) in zip(names, run_concurrently(owner, names, max_workers)):
+        if not readable:
+            referenced.add(bucket)
+        elif stack in live and stack not in newest:
+            newest.add(stack)
+            referenced.add(bucket)
+    kept = names[:keep]
+    stale = [bucket for bucket in names[keep:] if bucket not in referenced]
+
+    def remove(bucket):
+        start = time.time()
+        result = {"bucket": bucket, "objects": 0, "error": None}
+        if not dry_run:
+            try:
+                result["objects"] = empty_and_delete_bucket(s3, bucket)
+            except BaseException as error:
+                result["error"] = str(error)
+        result["seconds"] = time.time() - start
+        return result
+
+    return {
+        "kept": kept,
+        "referenced": sorted(referenced.intersection(names[keep:])),
+        "deleted": run_concurrently(remove, stale, max_workers)
+    }
+
+
 if __name__ == "__main__":
     c = Cloudformation('test', 'file.json')
     c.create_stack()
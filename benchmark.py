@@ -0,0 +1,275 @@
+#!/bin/python
+'''Offline benchmarks for the template build path. Every stage runs against synthetic
+environments of increasing size in a fresh process, with fragments and templates written
+to tmpfs where available and boto3 replaced by an in memory S3 stub, and reports
+throughput, peak memory and serialized size. Results can be saved as json and compared
+against a previous run, e.g. from the parent commit:
+
+    python benchmark.py --json after.json --compare before.json
+
+--imports instead times a bare import of each template module in a new interpreter and
+fails if it loaded any of the AWS or network libraries, which only deploys should pay for
+'''
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import amazon_client
+from amazon_cf import Environment
+from amazon_client import Cloudformation
+from helper import (
+    Resource,
+    SecurityGroupRules
+)
+
+DEFAULT_SIZES = (10, 100, 1000, 10000)
+STAGES = ("build", "validation", "get_next_subnet",
+          "flush_fragments", "write_resources", "upload_to_s3", "upload_files")
+TEMPLATE_MODULES = ("amazon_cf", "helper", "graph", "template")
+HEAVY_MODULES = ("boto3", "botocore", "fabric", "requests", "netaddr")
+IMPORT_PROBE = '''
+import json, sys, time
+start = time.time()
+import {module}
+elapsed = time.time() - start
+print json.dumps({{"seconds": elapsed, "loaded": sorted(
+    name for name in {heavy} if name in sys.modules)}})
+'''
+
+
+def scratch_dir():
+    '''A temporary directory on tmpfs when the machine has one'''
+    return tempfile.mkdtemp(dir="/dev/shm" if os.path.isdir("/dev/shm") else None)
+
+
+def build_environment(name, size):
+    '''Builds an environment with roughly size resources spread over subnets,
+    routes and security groups, using the default lookups on every add'''
+    env = Environment(name, subnet_default=24, fragments="deferred")
+    env.add_vpc("VPC", cidr_block="10.0.0.0/8")
+    env.add_internet_gateway("internet gateway")
+    env.attach_internet_gateway("Attach gateway")
+    env.add_route_table("route table")
+    env.add_default_internet_route("To the internet")
+    rules = SecurityGroupRules("SecurityGroupIngress")
+    rules.add_rule("tcp", from_port=443, to_port=443, cidr_ip="0.0.0.0/0")
+    for i in range(max(size // 3, 1)):
+        env.add_subnet("subnet {}".format(i))
+        env.add_subnet_to_route_table("associate {}".format(i),
+                                      subnet="Subnet{}".format(i))
+        env.add_security_group("group {}".format(i), rules.rules, [])
+    env.add_launch_configuration("launch configuration", "ami-0", "t2.micro")
+    env.add_autoscaling_group("autoscaling group")
+    return env
+
+
+class StubConfig(object):
+    max_pool_connections = amazon_client.DEFAULT_POOL_CONNECTIONS
+
+
+class StubMeta(object):
+    region_name = "us-east-1"
+    config = StubConfig()
+
+
+class StubS3(object):
+    '''Just enough of the s3 client for Cloudformation's uploads, reads every body it is given'''
+
+    def __init__(self):
+        self.objects = {}
+        self.meta = StubMeta()
+
+    def create_bucket(self, **kwargs):
+        return {}
+
+    def head_bucket(self, **kwargs):
+        return {}
+
+    def put_bucket_tagging(self, **kwargs):
+        return {}
+
+    def put_object(self, Body, Key, Bucket):
+        self.objects[(Bucket, Key)] = len(Body.read())
+        return {}
+
+    def upload_file(self, Filename, Bucket, Key, **kwargs):
+        with open(Filename, 'rb') as body:
+            self.put_object(body, Key, Bucket)
+
+
+class StubBoto3(object):
+
+    def Session(self, **kwargs):
+        return self
+
+    def client(self, service, **kwargs):
+        return StubS3()
+
+
+def stage_build(size, workdir):
+    env = build_environment("benchmark", size)
+    return len(env.inventory_order), 0
+
+
+def stage_validation(size, workdir):
+    required = {"CidrBlock": str, "VpcId": dict}
+    optional = {"AvailabilityZone": dict, "MapPublicIpOnLaunch": bool, "Tags": list}
+    for i in range(size):
+        Resource("AWS::EC2::Subnet", required, optional,
+                 CidrBlock="10.0.0.0/24", VpcId={"Ref": "Vpc"},
+                 AvailabilityZone={"Fn::Select": [str(i % 3), {"Fn::GetAZs": ""}]})
+    return size, 0
+
+
+def stage_get_next_subnet(size, workdir):
+    env = Environment("benchmark", subnet_default=28, fragments=None)
+    env.add_vpc("VPC", cidr_block="10.0.0.0/8")
+    for i in range(size):
+        env.get_next_subnet()
+    return size, 0
+
+
+def stage_flush_fragments(size, workdir, env=None):
+    return env.flush_fragments(), sum(
+        os.path.getsize(os.path.join(env.name, name)) for name in os.listdir(env.name))
+
+
+def stage_write_resources(size, workdir, env=None):
+    report = env.write_resources("template.json")
+    return len(report["resources"]), report["total"]
+
+
+def stage_upload_to_s3(size, workdir, env=None):
+    Cloudformation("benchmark", "template.json", content_addressed=False).upload_to_s3()
+    return 1, os.path.getsize("template.json")
+
+
+def stage_upload_files(size, workdir, env=None):
+    env.flush_fragments()
+    report = Cloudformation("benchmark", "template.json", content_addressed=False,
+                            artifacts=[env.output]).upload_artifacts()
+    return report["uploaded"], report["bytes"]
+
+
+def measure(stage, size, results):
+    '''Runs one stage in the current (fresh) process and puts its numbers on results'''
+    workdir = scratch_dir()
+    os.chdir(workdir)
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, "w")
+    try:
+        function = globals()["stage_" + stage]
+        kwargs = {}
+        if stage in ("flush_fragments", "write_resources", "upload_to_s3", "upload_files"):
+            kwargs["env"] = build_environment("benchmark", size)
+        if stage in ("upload_to_s3", "upload_files"):
+            kwargs["env"].write_resources("template.json")
+            amazon_client.boto3 = StubBoto3()
+        # modules the build and upload paths import on first use, so their import
+        # time lands in --imports rather than in whichever stage runs first
+        import netaddr
+        import botocore.config
+        import boto3.s3.transfer
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        start = time.time()
+        count, size_bytes = function(size, workdir, **kwargs)
+        elapsed = time.time() - start
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    finally:
+        sys.stdout = stdout
+        shutil.rmtree(workdir)
+    results.put({
+        "stage": stage,
+        "size": size,
+        "count": count,
+        "seconds": elapsed,
+        "per_second": count / elapsed if elapsed else None,
+        "bytes_per_second": size_bytes / elapsed if elapsed else None,
+        "peak_kb": peak,
+        "peak_growth_kb": peak - before,
+        "bytes": size_bytes
+    })
+
+
+def run(stage, size):
+    results = multiprocessing.Queue()
+    process = multiprocessing.Process(target=measure, args=(stage, size, results))
+    process.start()
+    process.join()
+    if process.exitcode:
+        raise BaseException("{} at {} failed".format(stage, size))
+    return results.get()
+
+
+def import_costs(modules=TEMPLATE_MODULES, repeat=5):
+    '''Best of repeat imports of each module, every one in a new interpreter, and the heavy
+    modules it pulled in'''
+    here = os.path.dirname(os.path.abspath(__file__))
+    results = []
+    for module in modules:
+        probe = IMPORT_PROBE.format(module=module, heavy=HEAVY_MODULES)
+        runs = [json.loads(subprocess.check_output([sys.executable, "-c", probe], cwd=here))
+                for _ in range(repeat)]
+        results.append({
+            "module": module,
+            "seconds": min(run["seconds"] for run in runs),
+            "loaded": runs[0]["loaded"]
+        })
+    return results
+
+
+def check_imports():
+    results = import_costs()
+    print '{:<16} {:>10}  {}'.format('module', 'seconds', 'heavy modules loaded')
+    for result in results:
+        print '{module:<16} {seconds:>10.4f}  {loaded}'.format(
+            loaded=', '.join(result["loaded"]) or '-', module=result["module"],
+            seconds=result["seconds"])
+    if any(result["loaded"] for result in results):
+        sys.exit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("sizes", nargs="*", type=int, default=DEFAULT_SIZES)
+    parser.add_argument("--stage", action="append", choices=STAGES,
+                        help="only run these stages, may be repeated")
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--compare", help="results file from an earlier run")
+    parser.add_argument("--imports", action="store_true",
+                        help="only check import times of the template modules")
+    args = parser.parse_args()
+    if args.imports:
+        return check_imports()
+    previous = {}
+    if args.compare:
+        with open(args.compare) as baseline:
+            previous = dict(("{stage}/{size}".format(**result), result)
+                            for result in json.load(baseline))
+    results = []
+    print '{:<16} {:>7} {:>10} {:>12} {:>10} {:>12} {:>10} {:>9}'.format(
+        'stage', 'size', 'seconds', 'per second', 'peak kb', 'bytes', 'MB/s', 'vs prev')
+    for stage in args.stage or STAGES:
+        for size in args.sizes:
+            result = run(stage, size)
+            results.append(result)
+            before = previous.get("{}/{}".format(stage, size))
+            change = '{:.2f}x'.format(result["seconds"] / before["seconds"]) \
+                if before and before["seconds"] else ''
+            print '{stage:<16} {size:>7} {seconds:>10.4f} {rate:>12.0f} {peak_kb:>10} {bytes:>12} {mbps:>10.1f} {change:>9}'.format(
+                rate=result["per_second"] or 0,
+                mbps=(result["bytes_per_second"] or 0) / 1e6,
+                change=change, **result)
+    if args.json:
+        with open(args.json, "w") as output:
+            json.dump(results, output, indent=2)
+
+
+if __name__ == "__main__":
+    main()
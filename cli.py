@@ -0,0 +1,235 @@
+#!/bin/python
+'''Builds, and optionally deploys, many environments from one config file:
+
+    python cli.py build environments.json --jobs 4 --deploy
+
+`python cli.py spec` compiles the bundled resource specification into its cache ahead of
+time, as an install step, see spec.py.
+
+`python cli.py cleanup --keep 5` deletes old template buckets, see
+amazon_client.cleanup_buckets.
+
+The config is json. "defaults" apply to every environment and each entry in
+"environments" overrides them:
+
+    {
+        "defaults": {"builder": "my_env:build", "region": "eu-west-1"},
+        "environments": [
+            {"name": "dev", "options": {"stack_name": "dev"}},
+            {"name": "staging", "options": {"stack_name": "staging", "server_size": "t2.small"}}
+        ]
+    }
+
+    name        environment name, also its directory under --output
+    builder     module:function called with options plus name and output_dir, which
+                returns the Environment, my_env:build by default
+    options     keyword arguments for the builder
+    stack_name  stack to deploy to, options["stack_name"] or name by default, and
+                passed on to the builder as stack_name
+    region, bucket_name, profile    passed to Cloudformation when deploying
+
+Templates are built in a process pool, each environment writing its fragments to
+{output}/{name}/, its template to {output}/{name}.json and anything it prints to
+{output}/{name}.log. Deploys run in threads sharing amazon_client's clients.
+The run ends with a table of build and deploy times and exits non-zero if anything failed'''
+import argparse
+import importlib
+import json
+import multiprocessing
+import os
+import sys
+import time
+import traceback
+from multiprocessing.pool import ThreadPool
+
+DEFAULT_BUILDER = "my_env:build"
+
+
+def byte_strings(value):
+    '''json gives unicode, the resource validators expect str'''
+    if isinstance(value, unicode):
+        return value.encode("utf-8")
+    if isinstance(value, dict):
+        return dict((byte_strings(key), byte_strings(value[key])) for key in value)
+    if isinstance(value, list):
+        return [byte_strings(item) for item in value]
+    return value
+
+
+def positive_int(text):
+    '''argparse type for --jobs, a pool needs at least one worker'''
+    value = int(text)
+    if value < 1:
+        raise argparse.ArgumentTypeError("{} is not a positive number".format(text))
+    return value
+
+
+def load_config(filename):
+    '''The environments in filename with the defaults applied, in file order'''
+    with open(filename) as config_file:
+        config = byte_strings(json.load(config_file))
+    defaults = config.get("defaults", {})
+    environments = []
+    for entry in config.get("environments", []):
+        environment = dict(defaults)
+        environment.update(entry)
+        environment["options"] = dict(defaults.get("options", {}), **entry.get("options", {}))
+        if "name" not in environment:
+            raise BaseException("Every environment in {} needs a name".format(filename))
+        environment.setdefault("builder", DEFAULT_BUILDER)
+        environment.setdefault(
+            "stack_name", environment["options"].get("stack_name", environment["name"]))
+        environment["options"].setdefault("stack_name", environment["stack_name"])
+        environments.append(environment)
+    names = [environment["name"] for environment in environments]
+    duplicates = sorted(set(name for name in names if names.count(name) > 1))
+    if duplicates:
+        raise BaseException("Environment names must be unique: {}".format(', '.join(duplicates)))
+    return environments
+
+
+def load_builder(path):
+    module, function = path.split(":")
+    return getattr(importlib.import_module(module), function)
+
+
+def build_environment(job):
+    '''Pool worker, builds one environment and writes its template. Never raises, failures
+    come back as error so one bad environment does not stop the others'''
+    environment, output = job
+    name = environment["name"]
+    result = {"name": name, "stack_name": environment["stack_name"], "error": None,
+              "template": os.path.join(output, name + ".json"), "resources": 0,
+              "bytes": 0, "build_seconds": 0.0, "deploy_seconds": None}
+    start = time.time()
+    stdout = sys.stdout
+    try:
+        if not os.path.isdir(output):
+            os.makedirs(output)
+        with open(os.path.join(output, name + ".log"), "w") as log:
+            sys.stdout = log
+            builder = load_builder(environment["builder"])
+            env = builder(name=name, output_dir=output, **environment["options"])
+            report = env.write_resources(result["template"])
+        result["resources"] = len(report["resources"])
+        result["bytes"] = report["total"]
+    except BaseException:
+        result["error"] = traceback.format_exc().strip().splitlines()[-1]
+    finally:
+        sys.stdout = stdout
+    result["build_seconds"] = time.time() - start
+    return result
+
+
+def deploy_environment(job):
+    '''Thread worker, creates or updates the stack for one built environment'''
+    from amazon_client import Cloudformation
+    environment, result = job
+    start = time.time()
+    try:
+        kwargs = dict((key, environment[key]) for key in ("region", "bucket_name", "profile")
+                      if key in environment)
+        fragments = os.path.splitext(result["template"])[0]
+        if os.path.isdir(fragments):
+            kwargs["artifacts"] = [fragments]
+        Cloudformation(result["stack_name"], result["template"], **kwargs).deploy()
+    except BaseException:
+        result["error"] = traceback.format_exc().strip().splitlines()[-1]
+    result["deploy_seconds"] = time.time() - start
+    return result
+
+
+def summary(results):
+    print '{:<20} {:<20} {:>9} {:>10} {:>9} {:>9}  {}'.format(
+        'environment', 'stack', 'resources', 'bytes', 'build s', 'deploy s', 'status')
+    for result in results:
+        deploy = result["deploy_seconds"]
+        print '{name:<20} {stack_name:<20} {resources:>9} {bytes:>10} {build_seconds:>9.2f} {deploy:>9}  {status}'.format(
+            deploy='{:.2f}'.format(deploy) if deploy is not None else '-',
+            status=result["error"] or 'ok', **result)
+
+
+def build(args):
+    environments = load_config(args.config)
+    if args.only:
+        environments = [environment for environment in environments
+                        if environment["name"] in args.only]
+    output = os.path.abspath(args.output)
+    jobs = [(environment, output) for environment in environments]
+    pool = multiprocessing.Pool(min(args.jobs, len(jobs)) or 1)
+    try:
+        results = pool.map(build_environment, jobs)
+    finally:
+        pool.close()
+        pool.join()
+    if args.deploy:
+        ready = [(environment, result) for environment, result in zip(environments, results)
+                 if not result["error"]]
+        if ready:
+            threads = ThreadPool(min(args.jobs, len(ready)) or 1)
+            try:
+                threads.map(deploy_environment, ready)
+            finally:
+                threads.close()
+                threads.join()
+    summary(results)
+    return 1 if any(result["error"] for result in results) else 0
+
+
+def compile_specification(args):
+    from spec import build_cache
+    count = build_cache(args.spec, args.spec_cache)
+    print 'Compiled {} types from {} into {}'.format(count, args.spec, args.spec_cache)
+    return 0
+
+
+def cleanup(args):
+    from amazon_client import cleanup_buckets
+    report = cleanup_buckets(prefix=args.prefix, keep=args.keep, max_workers=args.jobs,
+                             dry_run=args.dry_run, region=args.region, profile=args.profile)
+    print 'Kept {} newest: {}'.format(len(report["kept"]), ', '.join(report["kept"]) or '-')
+    print 'Kept for live stacks: {}'.format(', '.join(report["referenced"]) or '-')
+    print '{:<40} {:>9} {:>9}  {}'.format('bucket', 'objects', 'seconds', 'status')
+    for result in report["deleted"]:
+        print '{bucket:<40} {objects:>9} {seconds:>9.2f}  {status}'.format(
+            status=result["error"] or ('would delete' if args.dry_run else 'deleted'), **result)
+    return 1 if any(result["error"] for result in report["deleted"]) else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    commands = parser.add_subparsers(dest="command")
+    build_parser = commands.add_parser("build", help="build the environments in a config file")
+    build_parser.add_argument("config", help="json file describing the environments")
+    build_parser.add_argument("--output", default="build",
+                              help="directory for the templates, one subdirectory per environment")
+    build_parser.add_argument("--jobs", type=positive_int, default=multiprocessing.cpu_count(),
+                              help="environments built, and deployed, at once")
+    build_parser.add_argument("--only", action="append",
+                              help="only this environment, may be repeated")
+    build_parser.add_argument("--deploy", action="store_true",
+                              help="create or update each stack once its template is built")
+    build_parser.set_defaults(run=build)
+    from spec import CACHE_FILE, SPEC_FILE
+    spec_parser = commands.add_parser("spec", help="compile the resource specification cache")
+    spec_parser.add_argument("--spec", default=SPEC_FILE, help="specification json")
+    spec_parser.add_argument("--spec-cache", default=CACHE_FILE, help="cache file to write")
+    spec_parser.set_defaults(run=compile_specification)
+    cleanup_parser = commands.add_parser("cleanup", help="delete stale template buckets")
+    cleanup_parser.add_argument("--prefix", default="cloudformation",
+                                help="bucket_name the buckets were created with")
+    cleanup_parser.add_argument("--keep", type=int, default=5,
+                                help="newest buckets to leave alone")
+    cleanup_parser.add_argument("--jobs", type=positive_int, default=4,
+                                help="buckets emptied at once")
+    cleanup_parser.add_argument("--dry-run", action="store_true",
+                                help="only list the buckets that would be deleted")
+    cleanup_parser.add_argument("--region")
+    cleanup_parser.add_argument("--profile")
+    cleanup_parser.set_defaults(run=cleanup)
+    args = parser.parse_args(argv)
+    return args.run(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,198 @@
+'''Dependency analysis for Environment templates. A resource depends on everything named in
+its DependsOn and on every resource its properties Ref or Fn::GetAtt. CloudFormation creates
+resources in parallel as soon as what they depend on exists, so DependsOn entries that the
+references already imply only hide the real shape of the graph, and the longest chain of
+dependencies is the floor on how long a stack takes to create'''
+
+
+def as_list(value):
+    '''DependsOn may be a single name or a list of names'''
+    if not value:
+        return []
+    return value if isinstance(value, list) else [value]
+
+
+def find_references(obj):
+    '''Yields (resource, attribute) for every Ref and Fn::GetAtt in obj, attribute is None for a Ref'''
+    if isinstance(obj, dict):
+        if len(obj) == 1 and "Ref" in obj:
+            yield obj["Ref"], None
+        elif len(obj) == 1 and "Fn::GetAtt" in obj:
+            yield obj["Fn::GetAtt"][0], obj["Fn::GetAtt"][1]
+        else:
+            for key in obj:
+                for reference in find_references(obj[key]):
+                    yield reference
+    elif isinstance(obj, list):
+        for item in obj:
+            for reference in find_references(item):
+                yield reference
+
+
+def dependency_order(order, depends):
+    '''Orders names so everything comes after what it depends on, otherwise keeping the given order'''
+    placed = set()
+    result = []
+    visiting = set()
+
+    def visit(name):
+        if name in placed or name in visiting:
+            return
+        visiting.add(name)
+        for target in depends.get(name, []):
+            visit(target)
+        visiting.discard(name)
+        placed.add(name)
+        result.append(name)
+
+    for name in order:
+        visit(name)
+    return result
+
+
+def find_cycle(depends):
+    '''Returns a list of names forming a cycle in depends, or None'''
+    state = {}
+    for start in depends:
+        if start in state:
+            continue
+        stack = [(start, iter(depends.get(start, [])))]
+        path = [start]
+        state[start] = "open"
+        while stack:
+            name, targets = stack[-1]
+            for target in targets:
+                if state.get(target) == "open":
+                    return path[path.index(target):] + [target]
+                if target not in state:
+                    state[target] = "open"
+                    stack.append((target, iter(depends.get(target, []))))
+                    path.append(target)
+                    break
+            else:
+                state[name] = "done"
+                stack.pop()
+                path.pop()
+    return None
+
+
+class DependencyCycle(BaseException):
+    '''Raised when resources depend on each other, cycle lists the names going round'''
+
+    def __init__(self, cycle):
+        self.cycle = cycle
+        BaseException.__init__(self, 'Circular dependency: {}'.format(' -> '.join(cycle)))
+
+
+class DependencyGraph(object):
+    '''DAG over the resources of a template. resources is a list of
+    (name, DependsOn, Properties) and edges only point at names in that list, so Refs to
+    parameters and pseudo parameters like AWS::Region are left out.
+        explicit   name -> DependsOn targets
+        implicit   name -> resources referenced by Ref or Fn::GetAtt
+        depends    name -> both, explicit first, in the order they were found'''
+
+    def __init__(self, resources):
+        self.order = [name for name, depends_on, properties in resources]
+        names = set(self.order)
+        self.explicit = {}
+        self.implicit = {}
+        self.depends = {}
+        for name, depends_on, properties in resources:
+            explicit = []
+            for target in as_list(depends_on):
+                if target in names and target != name and target not in explicit:
+                    explicit.append(target)
+            self.explicit[name] = explicit
+            implicit = []
+            for target, attribute in find_references(properties):
+                if target in names and target != name and target not in implicit:
+                    implicit.append(target)
+            self.implicit[name] = implicit
+            depends = list(self.explicit[name])
+            depends.extend(target for target in implicit if target not in depends)
+            self.depends[name] = depends
+        self.levels = None
+
+    def cycle(self):
+        '''A list of names going round a cycle, or None when the graph is a DAG'''
+        return find_cycle(self.depends)
+
+    def check(self):
+        cycle = self.cycle()
+        if cycle:
+            raise DependencyCycle(cycle)
+
+    def topological(self):
+        '''Names with every resource after what it depends on, otherwise in template order'''
+        self.check()
+        return dependency_order(self.order, self.depends)
+
+    def reachable(self):
+        '''name -> bitmask of every resource name transitively depends on, bit i is self.order[i]'''
+        index = dict((name, i) for i, name in enumerate(self.order))
+        reach = {}
+        for name in self.topological():
+            mask = 0
+            for target in self.depends[name]:
+                mask |= reach[target] | (1 << index[target])
+            reach[name] = mask
+        return reach
+
+    def redundant(self):
+        '''DependsOn entries the graph implies anyway, as (name, target): the target is
+        referenced directly, or is reached through another of the resource's dependencies.
+        Dropping all of them at once keeps every ordering CloudFormation has to respect'''
+        index = dict((name, i) for i, name in enumerate(self.order))
+        reach = self.reachable()
+        redundant = []
+        for name in self.order:
+            for target in self.explicit[name]:
+                if target in self.implicit[name]:
+                    redundant.append((name, target))
+                    continue
+                bit = 1 << index[target]
+                for other in self.depends[name]:
+                    if other != target and reach[other] & bit:
+                        redundant.append((name, target))
+                        break
+        return redundant
+
+    def level(self):
+        '''name -> creation wave, 1 for resources that depend on nothing, otherwise one more
+        than the deepest dependency. With unlimited parallelism a resource can start in its wave'''
+        if self.levels is None:
+            levels = {}
+            for name in self.topological():
+                levels[name] = 1 + max([levels[target] for target in self.depends[name]] or [0])
+            self.levels = levels
+        return self.levels
+
+    def critical_path(self):
+        '''The longest chain of dependencies, from a resource that depends on nothing to the last one created'''
+        levels = self.level()
+        if not levels:
+            return []
+        name = max(self.order, key=lambda name: levels[name])
+        path = [name]
+        while self.depends[name]:
+            name = max(self.depends[name], key=lambda target: levels[target])
+            path.append(name)
+        return path[::-1]
+
+    def report(self):
+        '''Summary of the graph: sizes, redundant DependsOn entries, depth of the critical
+        path and how many resources each creation wave holds'''
+        levels = self.level()
+        waves = {}
+        for name in levels:
+            waves[levels[name]] = waves.get(levels[name], 0) + 1
+        return {
+            "resources": len(self.order),
+            "edges": sum(len(self.depends[name]) for name in self.order),
+            "depends_on": sum(len(self.explicit[name]) for name in self.order),
+            "redundant": self.redundant(),
+            "depth": max(waves) if waves else 0,
+            "critical_path": self.critical_path(),
+            "waves": [waves[level] for level in sorted(waves)]
+        }
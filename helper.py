@@ -1,43 +1,300 @@
-import requests
+import csv
+import fnmatch
+import json
+import heapq
 import os
+import Queue
+import threading
+import time
 
 class BaseHelper(object):
     def exception(self, problem):
         raise BaseException(problem)
 
+INTRINSIC_FUNCTIONS = frozenset([
+    "Ref",
+    "Fn::Base64",
+    "Fn::FindInMap",
+    "Fn::GetAtt",
+    "Fn::GetAZs",
+    "Fn::ImportValue",
+    "Fn::Join",
+    "Fn::Select",
+    "Fn::Split",
+    "Fn::Sub",
+    "Fn::If",
+    "Fn::Equals",
+    "Fn::And",
+    "Fn::Or",
+    "Fn::Not"
+])
+
+
+def is_intrinsic(value):
+   '''True for a {"Ref": ..} or {"Fn::..": ..} node, which resolves to any type at deploy time'''
+   return isinstance(value, dict) and len(value) == 1 and next(iter(value)) in INTRINSIC_FUNCTIONS
+
+
+class ValidationError(BaseException):
+   '''Raised with every problem found in a set of properties rather than just the first'''
+
+   def __init__(self, _type, errors):
+      self.type = _type
+      self.errors = errors
+      BaseException.__init__(self, '{}: {}'.format(_type, '; '.join(errors)))
+
+
+class Validator(object):
+   '''Schema for one resource type, compiled once and shared by every Resource of that type'''
+
+   def __init__(self, _type, required_keys, optional_keys):
+      self.type = _type
+      self.required = tuple(required_keys)
+      self.types = dict(optional_keys)
+      self.types.update(required_keys)
+      self.keys = {
+          "Required": dict(required_keys),
+          "All": self.types
+      }
+
+   def validate(self, properties):
+      '''Returns a list of everything wrong with properties, empty when they are valid'''
+      errors = ['{} required'.format(key) for key in self.required if key not in properties]
+      types = self.types
+      for key in properties:
+         value = properties[key]
+         expected = types.get(key)
+         if expected is None:
+            errors.append('{} is not a valid property'.format(key))
+         elif type(value) != expected and not is_intrinsic(value):
+            errors.append('{} is wrong format {} {}'.format(key, type(value), expected))
+      return errors
+
+
+def numeric(value):
+   try:
+      float(value)
+   except (TypeError, ValueError):
+      return False
+   return True
+
+
+PRIMITIVES = {
+   "String": lambda value: isinstance(value, (basestring, int, long, float)),
+   "Integer": lambda value: isinstance(value, (int, long)) or (isinstance(value, basestring) and value.lstrip("-").isdigit()),
+   "Long": lambda value: isinstance(value, (int, long)) or (isinstance(value, basestring) and value.lstrip("-").isdigit()),
+   "Double": lambda value: isinstance(value, (int, long, float)) or (isinstance(value, basestring) and numeric(value)),
+   "Boolean": lambda value: isinstance(value, bool) or value in ("true", "false", "True", "False"),
+   "Timestamp": lambda value: isinstance(value, basestring),
+   "Json": lambda value: isinstance(value, (dict, list, basestring))
+}
+
+
+class SpecValidator(object):
+   '''Validator for a resource type in the CloudFormation resource specification (spec.py),
+   checking nested property types, lists and maps as well. Primitives are as lenient as
+   CloudFormation itself: "80" is a fine Integer and 80 a fine String'''
+
+   def __init__(self, _type, specification):
+      self.type = _type
+      self.specification = specification
+      required, properties = specification.schema(_type)
+      self.keys = {
+          "Required": dict((key, properties[key]) for key in required),
+          "All": properties
+      }
+
+   def validate(self, properties):
+      '''Returns a list of everything wrong with properties, empty when they are valid'''
+      errors = []
+      self.check_struct(self.type, properties, "", errors)
+      return errors
+
+   def check_struct(self, name, value, path, errors):
+      schema = self.specification.schema(name)
+      if schema is None:
+         return
+      required, properties = schema
+      for key in required:
+         if key not in value:
+            errors.append('{}{} required'.format(path, key))
+      for key in value:
+         prop = properties.get(key)
+         if prop is None:
+            errors.append('{}{} is not a valid property'.format(path, key))
+         else:
+            self.check(prop, value[key], path + key, errors)
+
+   def check(self, prop, value, path, errors):
+      kind, detail = prop
+      if kind == "primitive":
+         valid = PRIMITIVES.get(detail)
+         if valid and not valid(value) and not is_intrinsic(value):
+            errors.append('{} is wrong format {} {}'.format(path, type(value), detail))
+      elif is_intrinsic(value):
+         return
+      elif kind == "list":
+         if not isinstance(value, list):
+            errors.append('{} is wrong format {} List'.format(path, type(value)))
+            return
+         for index, item in enumerate(value):
+            self.check(detail, item, '{}[{}]'.format(path, index), errors)
+      elif kind == "map":
+         if not isinstance(value, dict):
+            errors.append('{} is wrong format {} Map'.format(path, type(value)))
+            return
+         for key in value:
+            self.check(detail, value[key], '{}.{}'.format(path, key), errors)
+      elif not isinstance(value, dict):
+         errors.append('{} is wrong format {} {}'.format(path, type(value), detail))
+      else:
+         self.check_struct(detail, value, path + ".", errors)
+
+
+VALIDATORS = {}
+
+
+def get_validator(_type, required_keys, optional_keys):
+   '''Returns the cached validator for this type, compiling it on first use. Types in the
+   bundled resource specification get a SpecValidator and the hand written keys are only
+   used for types it does not cover'''
+   from spec import default_specification
+   specification = default_specification()
+   if specification.has_resource(_type):
+      validator = VALIDATORS.get(_type)
+      if validator is None:
+         validator = VALIDATORS[_type] = SpecValidator(_type, specification)
+      return validator
+   key = (_type, frozenset(required_keys.items()), frozenset(optional_keys.items()))
+   validator = VALIDATORS.get(key)
+   if validator is None:
+      validator = VALIDATORS[key] = Validator(_type, required_keys, optional_keys)
+   return validator
+
+
 class Resource(BaseHelper):
 
     def __init__(self, _type, required_keys, optional_keys,  **kwargs):
         self.type = _type
-        self.keys = {
-            "Required": {key: required_keys[key] for key in required_keys},
-            "All": {key: optional_keys[key] for key in optional_keys}
-        }
-        for key in self.keys["Required"]:
-            self.keys["All"][key] = self.keys["Required"][key]
+        self.validator = get_validator(_type, required_keys, optional_keys)
+        self.keys = self.validator.keys
         self.object = {}
         if _type == "AWS::ElasticLoadBalancing::LoadBalancer":
            print kwargs
         if kwargs:
-            for key in self.keys["Required"]:
-                if key not in kwargs:
-                    self.exception('{} required'.format(key))
-
+            errors = self.validator.validate(kwargs)
+            if errors:
+                raise ValidationError(_type, errors)
             for key in kwargs:
-                try:
-                   self.object[key] = kwargs[key] if type(kwargs[key]) == self.keys["All"][key] else self.exception('')
-                except BaseException:
-                   try:
-                      if kwargs[key]["Ref"]:
-                         self.object[key] = kwargs[key]
-                   except:
-                      self.exception(
-                      '''{} is wrong format {} {}'''.format(key, type(kwargs[key]), self.keys["All"][key]))
+                self.object[key] = kwargs[key]
 
     def return_resource(self):
         self.resource = {"Type": self.type, "Properties": self.object}
         return self.resource 
 
+class SubnetAllocator(BaseHelper):
+   '''Buddy allocator over one VPC's CIDR block. Free blocks are kept per prefix length in a
+   set for membership and a heap for lowest address first, so allocate, reserve and release
+   are logarithmic and subnets of mixed sizes never overlap. Allocating one prefix size
+   repeatedly hands out the same sequence as netaddr's subnet() generator'''
+
+   def __init__(self, cidr_block, default_prefix=24):
+      import netaddr
+      self.ip_network = netaddr.IPNetwork
+      network = self.ip_network(cidr_block).cidr
+      self.network = network
+      self.bits = 32 if network.version == 4 else 128
+      self.base_prefix = network.prefixlen
+      self.default_prefix = default_prefix
+      self.free = dict((prefix, set()) for prefix in range(self.base_prefix, self.bits + 1))
+      self.heaps = dict((prefix, []) for prefix in self.free)
+      self.allocated = set()
+      self.add_free(network.value, self.base_prefix)
+
+   def block_size(self, prefix):
+      return 1 << (self.bits - prefix)
+
+   def add_free(self, start, prefix):
+      self.free[prefix].add(start)
+      heapq.heappush(self.heaps[prefix], start)
+
+   def pop_free(self, prefix):
+      '''Removes and returns the lowest free block of this prefix, None if there is none'''
+      heap = self.heaps[prefix]
+      free = self.free[prefix]
+      while heap:
+         start = heapq.heappop(heap)
+         if start in free:
+            free.discard(start)
+            return start
+      return None
+
+   def split(self, start, prefix, target):
+      '''Splits the block down to target, freeing the upper half at each level'''
+      while prefix < target:
+         prefix += 1
+         self.add_free(start + self.block_size(prefix), prefix)
+
+   def parse(self, cidr_block):
+      subnet = self.ip_network(cidr_block)
+      if subnet.cidr != subnet or subnet not in self.network:
+         self.exception('{} is not a block inside {}'.format(cidr_block, self.network))
+      return subnet.value, subnet.prefixlen
+
+   def check_prefix(self, prefix):
+      if not self.base_prefix <= prefix <= self.bits:
+         self.exception('/{} does not fit in {}'.format(prefix, self.network))
+
+   def allocate(self, prefix=None):
+      '''Hands out the lowest free block of the given prefix length'''
+      prefix = prefix or self.default_prefix
+      self.check_prefix(prefix)
+      for size in range(prefix, self.base_prefix - 1, -1):
+         start = self.pop_free(size)
+         if start is not None:
+            break
+      else:
+         self.exception('No free /{} left in {}'.format(prefix, self.network))
+      self.split(start, size, prefix)
+      self.allocated.add((start, prefix))
+      return str(self.ip_network((start, prefix), version=self.network.version))
+
+   def reserve(self, cidr_block):
+      '''Marks an explicit block as used so allocate never hands it out, raising if it overlaps
+      anything already allocated or reserved'''
+      start, prefix = self.parse(cidr_block)
+      for size in range(prefix, self.base_prefix - 1, -1):
+         aligned = start & ~(self.block_size(size) - 1)
+         if aligned in self.free[size]:
+            self.free[size].discard(aligned)
+            break
+      else:
+         self.exception('{} overlaps a subnet already in use'.format(cidr_block))
+      while size < prefix:
+         size += 1
+         half = self.block_size(size)
+         lower = aligned if start < aligned + half else aligned + half
+         self.add_free(aligned + half if lower == aligned else aligned, size)
+         aligned = lower
+      self.allocated.add((start, prefix))
+      return str(self.ip_network((start, prefix), version=self.network.version))
+
+   def release(self, cidr_block):
+      '''Returns a block, merging it with its free buddies'''
+      start, prefix = self.parse(cidr_block)
+      if (start, prefix) not in self.allocated:
+         self.exception('{} was never allocated'.format(cidr_block))
+      self.allocated.discard((start, prefix))
+      while prefix > self.base_prefix:
+         buddy = start ^ self.block_size(prefix)
+         if buddy not in self.free[prefix]:
+            break
+         self.free[prefix].discard(buddy)
+         start = min(start, buddy)
+         prefix -= 1
+      self.add_free(start, prefix)
+
+
 class Listener(BaseHelper):
    def __init__(self, loadbalancer_port, instance_port, policy_names=None, ssl_certificate_id=None, inst_protocol='TCP', lb_protocol='TCP'):
       self.instance_port = instance_port
@@ -63,16 +320,21 @@ class Listener(BaseHelper):
 
 
 class SecurityGroupRules(BaseHelper):
+    fields = ("ip_protocol", "cidr_ip", "from_port", "to_port", "source_security_group_id",
+              "source_security_group_name", "destination_security_group_id")
+    port_protocols = ("tcp", "udp", "6", "17")
 
     def __init__(self, _type):
         self.type = _type
         self.rules = []
+        self.index = set()
         self.options = "SecurityGroupIngress", "SecurityGroupEgress"
         if self.type not in self.options:
             self.exception(
                 "Type set incorecctly must be in {}".format(self.options))
 
-    def add_rule(self, ip_protocol, cidr_ip=None, from_port=None, to_port=None, source_security_group_id=None, source_security_group_name=None, destination_security_group_id=None):
+    def make_rule(self, ip_protocol, cidr_ip=None, from_port=None, to_port=None, source_security_group_id=None, source_security_group_name=None, destination_security_group_id=None):
+        '''Returns (rule, problems) without adding anything'''
         raw_rule = {
             "IpProtocol": ip_protocol,
             "CidrIp": cidr_ip,
@@ -82,24 +344,150 @@ class SecurityGroupRules(BaseHelper):
             "SourceSecurityGroupName": source_security_group_name,
             "DestinationSecurityGroupId": destination_security_group_id
         }
-
+        problems = []
         if self.type == "SecurityGroupIngress" and destination_security_group_id:
-            self.exception(
+            problems.append(
                 "Ingress and destiniation_security_group_id incompatible")
-        elif self.type == "SecurityGroupEgress" and source_security_group_name or source_security_group_id:
-            self.exception(
+        elif self.type == "SecurityGroupEgress" and (source_security_group_name or source_security_group_id):
+            problems.append(
                 "Engress and source_security_group_id/name incompatible")
         for key in raw_rule:
             if raw_rule[key] and key in ("FromPort", "ToPort"):
                 if type(raw_rule[key]) != int:
-                    self.exception("{} should be int, got {}".format(
+                    problems.append("{} should be int, got {}".format(
                         key, type(raw_rule[key])))
             elif raw_rule[key]:
                 if type(raw_rule[key]) != str:
-                    self.exception("{} should be str, got {}".format(
+                    problems.append("{} should be str, got {}".format(
                         key, type(raw_rule[key])))
-        self.rules.append({key: raw_rule[key]
-                           for key in raw_rule if raw_rule[key]})
+        return {key: raw_rule[key] for key in raw_rule if raw_rule[key]}, problems
+
+    def add_rule(self, ip_protocol, cidr_ip=None, from_port=None, to_port=None, source_security_group_id=None, source_security_group_name=None, destination_security_group_id=None):
+        rule, problems = self.make_rule(ip_protocol, cidr_ip, from_port, to_port, source_security_group_id,
+                                        source_security_group_name, destination_security_group_id)
+        key = frozenset(rule.items())
+        if key in self.index:
+            problems.append("Duplicate rule {}".format(rule))
+        if problems:
+            self.exception("; ".join(problems))
+        self.index.add(key)
+        self.rules.append(rule)
+
+    def add_rules(self, rules):
+        '''Adds an iterable of rules, each a dict of add_rule's arguments or a tuple in the same
+        order. Everything is validated first, so either every rule is added or a
+        ValidationError lists all the problems, duplicates included'''
+        new_rules = []
+        new_keys = set()
+        errors = []
+        for number, arguments in enumerate(rules, 1):
+            if isinstance(arguments, dict):
+                rule, problems = self.make_rule(**arguments)
+            else:
+                rule, problems = self.make_rule(*arguments)
+            key = frozenset(rule.items())
+            if key in self.index or key in new_keys:
+                problems.append("Duplicate rule {}".format(rule))
+            errors.extend("rule {}: {}".format(number, problem) for problem in problems)
+            new_keys.add(key)
+            new_rules.append(rule)
+        if errors:
+            raise ValidationError(self.type, errors)
+        self.index.update(new_keys)
+        self.rules.extend(new_rules)
+
+    def add_rules_csv(self, csv_file):
+        '''Adds rules from a CSV file (a path or an open file) whose header names add_rule's
+        arguments, e.g. ip_protocol,cidr_ip,from_port,to_port. Empty cells are left unset'''
+        source = open(csv_file) if isinstance(csv_file, basestring) else csv_file
+        try:
+            rows = list(csv.DictReader(source))
+        finally:
+            if source is not csv_file:
+                source.close()
+        rules = []
+        for row in rows:
+            arguments = dict((key.strip(), value.strip()) for key, value in row.items()
+                             if key and value and value.strip())
+            for port in ("from_port", "to_port"):
+                if port in arguments and arguments[port].lstrip("-").isdigit():
+                    arguments[port] = int(arguments[port])
+            rules.append(arguments)
+        self.add_rules(rules)
+
+    def compact(self):
+        '''Rewrites the rules as the smallest equivalent set: overlapping or adjacent tcp/udp port
+        ranges on the same source are coalesced, then CIDRs sharing a protocol and port
+        range are merged with netaddr.cidr_merge. Repeats until nothing changes'''
+        rules = self.rules
+        while True:
+            compacted = self.merge_cidrs(self.merge_ports(rules))
+            if len(compacted) == len(rules):
+                break
+            rules = compacted
+        self.rules = compacted
+        self.index = set(frozenset(rule.items()) for rule in compacted)
+        return self.rules
+
+    def merge_ports(self, rules):
+        groups = {}
+        order = []
+        for rule in rules:
+            if str(rule.get("IpProtocol")).lower() not in self.port_protocols or "FromPort" not in rule:
+                key = ("rule", frozenset(rule.items()))
+                value = None
+            else:
+                key = ("ports", frozenset((k, v) for k, v in rule.items() if k not in ("FromPort", "ToPort")))
+                value = (rule["FromPort"], rule.get("ToPort", rule["FromPort"]))
+            if key not in groups:
+                groups[key] = []
+                order.append(key)
+            if value:
+                groups[key].append(value)
+        merged = []
+        for kind, key in order:
+            ranges = sorted(groups[(kind, key)])
+            if not ranges:
+                merged.append(dict(key))
+                continue
+            current = list(ranges[0])
+            for low, high in ranges[1:]:
+                if low <= current[1] + 1:
+                    current[1] = max(current[1], high)
+                else:
+                    merged.append(dict(key, FromPort=current[0], ToPort=current[1]))
+                    current = [low, high]
+            merged.append(dict(key, FromPort=current[0], ToPort=current[1]))
+        return merged
+
+    def merge_cidrs(self, rules):
+        groups = {}
+        order = []
+        for rule in rules:
+            key = frozenset((k, v) for k, v in rule.items() if k != "CidrIp")
+            if key not in groups:
+                groups[key] = []
+                order.append(key)
+            groups[key].append(rule.get("CidrIp"))
+        merged = []
+        for key in order:
+            cidrs = groups[key]
+            if None in cidrs:
+                merged.append(dict(key))
+            cidrs = [cidr for cidr in cidrs if cidr]
+            if cidrs:
+                import netaddr
+                merged.extend(dict(key, CidrIp=str(cidr)) for cidr in netaddr.cidr_merge(cidrs))
+        return merged
+
+# characters IAM allows across all of an entity's inline policies, whitespace excluded
+IAM_POLICY_LIMITS = {"user": 2048, "group": 5120, "role": 10240}
+
+
+def action_covers(pattern, action):
+   '''True when the wildcard action pattern matches action, IAM actions are case insensitive'''
+   return fnmatch.fnmatchcase(action.lower(), pattern.lower())
+
 
 class UserPolicy(BaseHelper):
 
@@ -108,60 +496,343 @@ class UserPolicy(BaseHelper):
       self.name = name
       self.counter = 0
       self.policies = []
+      self.statements = []
 
-   def add_statement(self, rules):
+   def add_statement(self, rules, effect="Allow", resource="*"):
       statement = { 
                   "PolicyName" : self.name + str(self.counter),
                   "PolicyDocument": {
                      "Version": self.version,
                      "Statement": [ {
                         "Action" : rules,
-                        "Effect" : "Allow",
-                        "Resource" : "*"
+                        "Effect" : effect,
+                        "Resource" : resource
                         }]
                      }
                   }
       self.counter += 1
       self.policies.append(statement)
-   
+      self.statements.append(statement["PolicyDocument"]["Statement"][0])
+
+   def merge_statements(self):
+      '''Merges statements with the same effect and resource, dropping repeated actions and
+      actions a wildcard in the same statement already covers'''
+      merged = {}
+      order = []
+      for statement in self.statements:
+         key = (statement["Effect"], json.dumps(statement["Resource"], sort_keys=True))
+         if key not in merged:
+            merged[key] = ({"Effect": statement["Effect"], "Resource": statement["Resource"]}, [], set())
+            order.append(key)
+         body, actions, seen = merged[key]
+         rules = statement["Action"]
+         for action in ([rules] if isinstance(rules, basestring) else rules):
+            if action.lower() not in seen:
+               seen.add(action.lower())
+               actions.append(action)
+      statements = []
+      for key in order:
+         body, actions, seen = merged[key]
+         patterns = {}
+         for action in actions:
+            if "*" in action or "?" in action:
+               patterns.setdefault(action.split(":")[0].lower() if ":" in action else "*", []).append(action)
+         kept = []
+         for action in actions:
+            service = action.split(":")[0].lower()
+            candidates = patterns.get(service, []) + patterns.get("*", [])
+            if not any(pattern != action and action_covers(pattern, action) and
+                       not (action_covers(action, pattern) and actions.index(action) < actions.index(pattern))
+                       for pattern in candidates):
+               kept.append(action)
+         body["Action"] = kept
+         statements.append(body)
+      return statements
+
+   def pack(self, entity="role"):
+      '''Replaces policies with a single policy holding merge_statements(), for an inline
+      policy on entity, "user", "group" or "role". IAM limits the PolicyDocuments of all of an
+      entity's inline policies together, once whitespace is dropped, to
+      IAM_POLICY_LIMITS[entity] characters, so splitting gains nothing and this raises when
+      the one document is over it'''
+      if entity not in IAM_POLICY_LIMITS:
+         self.exception("entity must be one of {}".format(", ".join(sorted(IAM_POLICY_LIMITS))))
+      max_size = IAM_POLICY_LIMITS[entity]
+      document = {
+         "Version": self.version,
+         "Statement": self.merge_statements()
+         }
+      size = len(json.dumps(document, separators=(',', ':')))
+      if size > max_size:
+         self.exception("Policy for {} is {} characters, over the {} character limit for a {}".format(
+            self.name, size, max_size, entity))
+      self.policies = [{
+                      "PolicyName": self.name + "0",
+                      "PolicyDocument": document
+                      }]
+      self.counter = 1
+      return self.policies
+
 class ContainerDefinition(BaseHelper):
+   strings = [ "Name", "Image", "Hostname", "User", "WorkingDirectory"]
+   ints = [ "Cpu", "Memory" ]
+   lists = [
+            "Links", 
+            "PortMappings", 
+            "EntryPoint", 
+            "Command", 
+            "Environment", 
+            "MountPoints",
+            "VolumesFrom",
+            "DnsServers",
+            "DnsSearchDomains",
+            "ExtraHosts",
+            "DockerSecurityOptions",
+            "Ulimits"
+           ]
+   dicts = [ "LogConfiguration", "DockerLabels" ]
+   bools = ["DisableNetworking", "Privileged", "ReadonlyRootFilesystem", "Essential" ]
+   all_args = [(strings, str), (ints, int), (lists, list), (dicts, dict), (bools, bool)]
+   obj = {}
+   for list_, type_ in all_args:
+      obj.update(dict.fromkeys(list_, type_))
+   del list_, type_
+   validator = Validator("pseudo_container_resource", {}, obj)
+
    def __init__(self, **kwargs):
-      self.strings = [ "Name", "Image", "Hostname", "User", "WorkingDirectory"]
-      self.ints = [ "Cpu", "Memory" ]
-      self.lists = [
-               "Links", 
-               "PortMappings", 
-               "EntryPoint", 
-               "Command", 
-               "Environment", 
-               "MountPoints",
-               "VolumesFrom",
-               "DnsServers",
-               "DnsSearchDomains",
-               "ExtraHosts",
-               "DockerSecurityOptions",
-               "Ulimits"
-              ]
-      self.dicts = [ "LogConfiguration", "DockerLabels" ]
-      self.bools = ["DisableNetworking", "Privileged", "ReadonlyRootFilesystem", "Essential" ]
-      self.all_args = [(self.strings, str), (self.ints, int), (self.lists, list), (self.dicts, dict), (self.bools, bool)]
-      self.obj = {}
-      for list_, type_ in self.all_args:
-         self.obj.update({ arg : type_ for arg in list_ })
-      self.resource = Resource("pseudo_container_resource",{},self.obj, **kwargs) 
+      self.object = self.check(kwargs)
+
+   @classmethod
+   def check(cls, definition):
+      '''Validates a single container definition and returns it as a plain dict'''
+      errors = cls.validator.validate(definition)
+      if errors:
+         raise ValidationError(cls.validator.type, errors)
+      return dict(definition)
+
+   @classmethod
+   def bulk(cls, definitions):
+      '''Validates every definition in an iterable in one pass, reporting the problems
+      of all of them together, and returns plain dicts ready for add_ecs_task'''
+      containers = []
+      errors = []
+      validate = cls.validator.validate
+      for index, definition in enumerate(definitions):
+         problems = validate(definition)
+         if problems:
+            label = definition.get("Name", index)
+            errors.extend('{}: {}'.format(label, problem) for problem in problems)
+         else:
+            containers.append(dict(definition))
+      if errors:
+         raise ValidationError(cls.validator.type, errors)
+      return containers
     
    def return_container(self):
-      return self.resource.object
+      return self.object
       
       
-def get_my_ip(block_size="/32"):
-   '''simple method to obtain external IP address'''
-   req = requests.get("http://icanhazip.com")
-   return str(req.text.split("\n")[0] + block_size)
+IP_PROVIDERS = (
+   "http://icanhazip.com",
+   "https://checkip.amazonaws.com",
+   "https://api.ipify.org"
+)
+
+
+def valid_ip(text):
+   '''The IP address in a provider's answer, None if it is not one. IPv4 must be four dotted
+   octets, short forms such as "127.1" are refused'''
+   import netaddr
+   text = text.strip()
+   try:
+      if netaddr.valid_ipv4(text, netaddr.INET_PTON):
+         return str(netaddr.IPAddress(text, flags=netaddr.INET_PTON))
+      return str(netaddr.IPAddress(text)) if netaddr.valid_ipv6(text) else None
+   except (netaddr.AddrFormatError, ValueError):
+      return None
+
+
+def read_cached_ip(cache_file, ttl):
+   try:
+      with open(cache_file) as cache:
+         cached = json.load(cache)
+   except (IOError, OSError, ValueError):
+      return None
+   if time.time() - cached.get("time", 0) > ttl:
+      return None
+   return valid_ip(cached.get("ip", ""))
+
+
+def write_cached_ip(cache_file, ip):
+   temp_file = "{}.{}".format(cache_file, os.getpid())
+   try:
+      with open(temp_file, "w") as cache:
+         json.dump({"ip": ip, "time": time.time()}, cache)
+      os.rename(temp_file, cache_file)
+   except (IOError, OSError):
+      if os.path.exists(temp_file):
+         os.remove(temp_file)
+
+
+def query_ip_providers(providers, timeout):
+   '''Asks every provider at once and returns the first valid answer, None if none arrives
+   within timeout seconds'''
+   import requests
+   answers = Queue.Queue()
+
+   def ask(url):
+      try:
+         answers.put(valid_ip(requests.get(url, timeout=timeout).text))
+      except Exception:
+         answers.put(None)
+
+   for url in providers:
+      thread = threading.Thread(target=ask, args=(url,))
+      thread.daemon = True
+      thread.start()
+   deadline = time.time() + timeout
+   for url in providers:
+      try:
+         ip = answers.get(timeout=max(deadline - time.time(), 0))
+      except Queue.Empty:
+         return None
+      if ip:
+         return ip
+   return None
+
+
+def get_my_ip(block_size="/32", providers=IP_PROVIDERS, timeout=3, ttl=3600, cache_file=None):
+   '''External IP address as a CIDR. MY_IP in the environment overrides everything for offline
+   builds, then an answer cached in cache_file less than ttl seconds ago, then every provider
+   is asked at once and the first valid answer within timeout seconds wins. Nothing is cached
+   unless a cache_file is given, e.g. one in the build's output directory'''
+   override = os.environ.get("MY_IP")
+   if override:
+      return str(override.split("/")[0] + block_size)
+   ip = read_cached_ip(cache_file, ttl) if cache_file else None
+   if not ip:
+      ip = query_ip_providers(providers, timeout)
+      if not ip:
+         raise BaseException("No external IP from {} within {}s".format(", ".join(providers), timeout))
+      if cache_file:
+         write_cached_ip(cache_file, ip)
+   return str(ip + block_size)
 
 def convert_to_aws_list(**kwargs):
    return [ {"Name": var, "Value": kwargs[var] } for var in kwargs ]
  
-def get_local_variables(vars_list):
-   '''Environment variable list pulled from local environment variables'''
-   return  convert_to_aws_list(**{ var : os.environ[var]  for var in vars_list })
+class MissingVariables(KeyError):
+   '''Raised with every variable no source could provide'''
+
+   def __init__(self, keys):
+      self.keys = keys
+      KeyError.__init__(self, ', '.join(keys))
+
+
+class EnvironmentSource(object):
+   '''Variables from the local environment'''
+
+   def fetch(self, keys):
+      return dict((key, os.environ[key]) for key in keys if key in os.environ)
+
+
+class FileSource(object):
+   '''Variables from a json object or a dotenv style KEY=value file, read on first use'''
+
+   def __init__(self, path):
+      self.path = path
+      self.values = None
+
+   def load(self):
+      with open(self.path) as source:
+         if self.path.endswith(".json"):
+            return dict((key, str(value)) for key, value in json.load(source).items())
+         values = {}
+         for line in source:
+            line = line.strip()
+            if not line or line.startswith("#") or "=" not in line:
+               continue
+            key, value = line.split("=", 1)
+            key = key.strip()
+            if key.startswith("export "):
+               key = key[len("export "):].strip()
+            values[key] = value.strip().strip("'\"")
+         return values
+
+   def fetch(self, keys):
+      if self.values is None:
+         self.values = self.load()
+      return dict((key, self.values[key]) for key in keys if key in self.values)
+
+
+class ParameterStoreSource(object):
+   '''Variables from SSM parameter store, prefix + key, fetched with get_parameters ten names
+   per call. client is anything with get_parameters, so a local stand in can be used'''
+   batch_size = 10
+
+   def __init__(self, client=None, prefix="", decrypt=True):
+      self.client = client
+      self.prefix = prefix
+      self.decrypt = decrypt
+
+   def fetch(self, keys):
+      if self.client is None:
+         import boto3
+         self.client = boto3.client("ssm")
+      names = dict((self.prefix + key, key) for key in keys)
+      found = {}
+      ordered = list(names)
+      for start in range(0, len(ordered), self.batch_size):
+         response = self.client.get_parameters(
+            Names=ordered[start:start + self.batch_size], WithDecryption=self.decrypt)
+         for parameter in response.get("Parameters", []):
+            found[names[parameter["Name"]]] = parameter["Value"]
+      return found
+
+
+class VariableResolver(object):
+   '''Looks variables up in each source in turn, asking a source only for what the ones
+   before it did not have and one call per source for a whole list. Values are memoized for
+   the life of the resolver and every missing key is reported together'''
+
+   def __init__(self, sources=None):
+      self.sources = sources or [EnvironmentSource()]
+      self.cache = {}
+      self.lists = {}
+
+   def resolve(self, keys):
+      missing = [key for key in set(keys) if key not in self.cache]
+      for source in self.sources:
+         if not missing:
+            break
+         self.cache.update(source.fetch(missing))
+         missing = [key for key in missing if key not in self.cache]
+      if missing:
+         raise MissingVariables(sorted(missing))
+      return dict((key, self.cache[key]) for key in keys)
+
+   def aws_list(self, keys):
+      '''Name/Value list for a container definition's Environment. The list is built once for
+      the same keys so many containers share one resolution, but every caller gets its own copy
+      to edit'''
+      lookup = tuple(keys)
+      if lookup not in self.lists:
+         values = self.resolve(keys)
+         self.lists[lookup] = convert_to_aws_list(**{ var : values[var] for var in keys })
+      return [dict(entry) for entry in self.lists[lookup]]
+
+
+RESOLVER = None
+
+
+def default_resolver():
+   '''Process wide resolver over the local environment, used by get_local_variables'''
+   global RESOLVER
+   if RESOLVER is None:
+      RESOLVER = VariableResolver()
+   return RESOLVER
+
+
+def get_local_variables(vars_list, resolver=None):
+   '''Environment variable list pulled from local environment variables, or from the sources of resolver'''
+   return (resolver or default_resolver()).aws_list(vars_list)
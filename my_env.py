@@ -11,31 +11,35 @@ from helper import (
     ContainerDefinition
 )
 
-if __name__ == "__main__":
-    # Manually created items and constants
-    key_name = 'id_rsa'
-    filename = 'file.json'
-    stack_name = 'dev'
-    server_size = "t2.micro"
-    ami = "ami-64385917"
-    app_container = "martyni/app"
-    nginx_container = "martyni/nginx"
-    domain = "martyni.co.uk."
-    ssl_cert = "arn:aws:acm:eu-west-1:526914317097:certificate/c162e6f8-3f40-4468-a03f-03f5c8d8ee63"
-    container_size = 450
-    environment_variables = [
-        "AWS_DEFAULT_PROFILE",
-        "MAIL_USERNAME",
-        "MAIL_PASSWORD",
-        "MAIL_DEFAULT_SENDER",
-        "MAIL_SERVER",
-        "MAIL_PORT",
-        "MAIL_USE_SSL"
-    ]
+ENVIRONMENT_VARIABLES = [
+    "AWS_DEFAULT_PROFILE",
+    "MAIL_USERNAME",
+    "MAIL_PASSWORD",
+    "MAIL_DEFAULT_SENDER",
+    "MAIL_SERVER",
+    "MAIL_PORT",
+    "MAIL_USE_SSL"
+]
+
+
+def build(stack_name='dev',
+          name='my_env',
+          output_dir=None,
+          key_name='id_rsa',
+          server_size="t2.micro",
+          ami="ami-64385917",
+          app_image="martyni/app",
+          nginx_image="martyni/nginx",
+          domain="martyni.co.uk.",
+          ssl_cert="arn:aws:acm:eu-west-1:526914317097:certificate/c162e6f8-3f40-4468-a03f-03f5c8d8ee63",
+          container_size=450,
+          environment_variables=ENVIRONMENT_VARIABLES):
+    '''Builds the environment for stack_name. Every argument can be set per environment in
+    the config given to cli.py build'''
     # Container configuration
     app_container = {
         "Name": "app",
-                "Image": app_container,
+                "Image": app_image,
                 "Cpu": container_size,
         "Memory": container_size,
         "Environment": get_local_variables(environment_variables),
@@ -43,7 +47,7 @@ if __name__ == "__main__":
     }
     nginx_container = {
         "Name": "nginx",
-                "Image": nginx_container,
+                "Image": nginx_image,
                 "Cpu": container_size,
                 "PortMappings": [
                     {
@@ -66,7 +70,7 @@ if __name__ == "__main__":
         "UnhealthyThreshold": 10
     }
     my_ip = get_my_ip()
-    my_env = Environment('my_env')
+    my_env = Environment(name, output_dir=output_dir)
     my_env.add_vpc("VPC")
     my_env.add_subnet("My first subnet", AvailabilityZone={
                       "Fn::Select": ["1", {"Fn::GetAZs": {"Ref": "AWS::Region"}}]})
@@ -145,8 +149,15 @@ if __name__ == "__main__":
         TTL="300",
         ResourceRecords=resource_record
     )
+    return my_env
+
+
+if __name__ == "__main__":
+    filename = 'file.json'
+    stack_name = 'dev'
+    my_env = build(stack_name)
     # Launch stack
     pprint(my_env.show_resources())
     my_env.write_resources(filename)
-    my_client = Cloudformation(stack_name, filename)
-    my_client.create_stack()
+    my_client = Cloudformation(stack_name, filename, artifacts=[my_env.output])
+    my_client.deploy()
@@ -0,0 +1,159 @@
+'''The CloudFormation resource specification that Resource validates against.
+
+specification.json is a copy of the official specification trimmed to the resource types
+Environment creates and the property types they use, so it can be swapped for a newer or
+complete download from AWS as is. Parsing it on every run is wasted work, so it is compiled
+into specification.cache: every resource and property type pickled on its own behind an
+index, read through mmap so looking up a type only unpickles that type. Only
+`python cli.py spec` writes the cache, as an install step; a missing or stale cache just
+means the json is compiled in memory, so builds never write next to the source'''
+import json
+import mmap
+import os
+import pickle
+import struct
+
+SPEC_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "specification.json")
+CACHE_FILE = os.path.splitext(SPEC_FILE)[0] + ".cache"
+CACHE_FORMAT = 1
+HEADER = struct.Struct(">Q")
+
+
+def compile_property(owner, prop):
+    '''Compact form of one property, ("primitive", name), ("list", item), ("map", item)
+    or ("struct", property type name)'''
+    base = owner.split(".")[0]
+
+    def item(primitive, name):
+        if primitive:
+            return ("primitive", primitive)
+        return ("struct", name if name == "Tag" else base + "." + name)
+
+    if "PrimitiveType" in prop:
+        return ("primitive", prop["PrimitiveType"])
+    if prop["Type"] in ("List", "Map"):
+        return (prop["Type"].lower(), item(prop.get("PrimitiveItemType"), prop.get("ItemType")))
+    return item(None, prop["Type"])
+
+
+def compile_type(name, definition):
+    '''(required property names, {property: compiled property}) for a resource or property type'''
+    properties = definition.get("Properties", {})
+    required = tuple(sorted(key for key in properties if properties[key].get("Required")))
+    return required, dict((key, compile_property(name, properties[key])) for key in properties)
+
+
+def compile_spec(spec):
+    '''{type name: compiled type} for every resource and property type in the specification'''
+    compiled = {}
+    for section in ("PropertyTypes", "ResourceTypes"):
+        for name in spec.get(section, {}):
+            compiled[name] = compile_type(name, spec[section][name])
+    return compiled
+
+
+def source_stamp(spec_file):
+    status = os.stat(spec_file)
+    return status.st_size, int(status.st_mtime)
+
+
+def build_cache(spec_file=SPEC_FILE, cache_file=CACHE_FILE):
+    '''Compiles spec_file into cache_file: a header holding the offset of the index, each
+    compiled type as its own pickle, then the index of (offset, length) by type name along
+    with the version and the size and mtime of the source it was built from.
+    Written to a temporary file and renamed into place so readers never see half a cache,
+    the temporary file is removed if anything fails'''
+    with open(spec_file) as source:
+        spec = json.load(source)
+    compiled = compile_spec(spec)
+    entries = {}
+    temp_file = "{}.{}".format(cache_file, os.getpid())
+    try:
+        with open(temp_file, "wb") as cache:
+            cache.write(HEADER.pack(0))
+            for name in sorted(compiled):
+                blob = pickle.dumps(compiled[name], pickle.HIGHEST_PROTOCOL)
+                entries[str(name)] = (cache.tell(), len(blob))
+                cache.write(blob)
+            index_offset = cache.tell()
+            pickle.dump({
+                "format": CACHE_FORMAT,
+                "version": spec.get("ResourceSpecificationVersion"),
+                "source": source_stamp(spec_file),
+                "resource_types": sorted(str(name) for name in spec.get("ResourceTypes", {})),
+                "entries": entries
+            }, cache, pickle.HIGHEST_PROTOCOL)
+            cache.seek(0)
+            cache.write(HEADER.pack(index_offset))
+        os.rename(temp_file, cache_file)
+    except BaseException:
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+        raise
+    return len(entries)
+
+
+class Specification(object):
+    '''Read side of the cache. schema(name) returns the compiled type, unpickling it on first
+    use, or None for types the specification does not have. Without a usable cache the json
+    is compiled in memory instead; the cache is only ever written by build_cache'''
+
+    def __init__(self, spec_file=SPEC_FILE, cache_file=CACHE_FILE):
+        self.spec_file = spec_file
+        self.cache_file = cache_file
+        self.schemas = {}
+        self.compiled = None
+        self.map = None
+        index = self.read_index()
+        if index is None:
+            with open(spec_file) as source:
+                spec = json.load(source)
+            self.compiled = compile_spec(spec)
+            self.version = spec.get("ResourceSpecificationVersion")
+            self.resource_types = frozenset(spec.get("ResourceTypes", {}))
+            self.entries = {}
+        else:
+            self.version = index["version"]
+            self.resource_types = frozenset(index["resource_types"])
+            self.entries = index["entries"]
+
+    def read_index(self):
+        '''The cache's index, None if there is no usable cache for spec_file'''
+        try:
+            with open(self.cache_file, "rb") as cache:
+                mapped = mmap.mmap(cache.fileno(), 0, access=mmap.ACCESS_READ)
+            offset, = HEADER.unpack(mapped[:HEADER.size])
+            index = pickle.loads(mapped[offset:])
+        except (IOError, OSError, ValueError, EOFError, struct.error, pickle.UnpicklingError):
+            return None
+        if index.get("format") != CACHE_FORMAT or index.get("source") != source_stamp(self.spec_file):
+            mapped.close()
+            return None
+        self.map = mapped
+        return index
+
+    def schema(self, name):
+        schema = self.schemas.get(name)
+        if schema is None:
+            if self.compiled is not None:
+                schema = self.compiled.get(name)
+            elif name in self.entries:
+                offset, length = self.entries[name]
+                schema = pickle.loads(self.map[offset:offset + length])
+            if schema is not None:
+                self.schemas[name] = schema
+        return schema
+
+    def has_resource(self, _type):
+        return _type in self.resource_types
+
+
+SPECIFICATION = None
+
+
+def default_specification():
+    '''The Specification shared by every validator in the process, loaded on first use'''
+    global SPECIFICATION
+    if SPECIFICATION is None:
+        SPECIFICATION = Specification()
+    return SPECIFICATION
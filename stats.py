@@ -0,0 +1,76 @@
+import json
+import time
+
+
+class BuildStats(object):
+    '''Timings, counters and byte totals collected while building and deploying a template.
+    Hand one to Environment and Cloudformation as stats=, then dump() it as json or emit()
+    it to sink, any callable taking the as_dict() result'''
+    enabled = True
+
+    def __init__(self, sink=None):
+        self.sink = sink
+        self.timings = {}
+        self.counters = {}
+
+    def add_time(self, name, seconds):
+        timing = self.timings.get(name)
+        if timing is None:
+            self.timings[name] = {"calls": 1, "seconds": seconds, "max": seconds}
+        else:
+            timing["calls"] += 1
+            timing["seconds"] += seconds
+            timing["max"] = max(timing["max"], seconds)
+
+    def count(self, name, amount=1):
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def timed(self, name, function):
+        '''Wraps function so every call is recorded under name'''
+        def wrapper(*args, **kwargs):
+            start = time.time()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.add_time(name, time.time() - start)
+        wrapper.__name__ = function.__name__
+        wrapper.__doc__ = function.__doc__
+        return wrapper
+
+    def as_dict(self):
+        return {"timings": self.timings, "counters": self.counters}
+
+    def dump(self, filename=None):
+        '''Returns the stats as json, also writing them to filename when given'''
+        body = json.dumps(self.as_dict(), indent=2, sort_keys=True)
+        if filename:
+            with open(filename, 'w') as output:
+                output.write(body)
+        return body
+
+    def emit(self):
+        if self.sink:
+            self.sink(self.as_dict())
+
+
+class NullStats(object):
+    '''Stand in used when instrumentation is off, callers check enabled before timing anything'''
+    enabled = False
+
+    def add_time(self, name, seconds):
+        pass
+
+    def count(self, name, amount=1):
+        pass
+
+    def as_dict(self):
+        return {"timings": {}, "counters": {}}
+
+    def dump(self, filename=None):
+        return json.dumps(self.as_dict())
+
+    def emit(self):
+        pass
+
+
+NULL_STATS = NullStats()
@@ -0,0 +1,133 @@
+'''Compact building blocks for Environment templates. Intrinsic functions are interned,
+immutable dict nodes shared by every property that uses them, and resources and outputs
+are kept as __slots__ records that only become dicts when the template is serialized'''
+import weakref
+
+
+class Intrinsic(dict):
+    '''A {"Ref": ..} or {"Fn::..": ..} node. It is a dict so json and the validators treat
+    it like one, but it cannot be changed, so one instance is shared by every property
+    that uses the same function and arguments. Build them with intrinsic()'''
+    __slots__ = ('__weakref__',)
+
+    def readonly(self, *args, **kwargs):
+        raise TypeError('Intrinsic nodes are shared and cannot be changed')
+
+    __setitem__ = __delitem__ = update = setdefault = pop = popitem = clear = readonly
+
+    def __reduce__(self):
+        function, args = next(iter(self.items()))
+        return intrinsic, (function, args)
+
+
+INTRINSICS = weakref.WeakValueDictionary()
+
+
+def freeze(value):
+    '''Hashable stand in for a json value, used as the interning key. Nested nodes are
+    interned already, so their identity stands for their content'''
+    if type(value) is Intrinsic:
+        return ('node', id(value))
+    if isinstance(value, dict):
+        return ('{}',) + tuple(sorted((key, freeze(value[key])) for key in value))
+    if isinstance(value, (list, tuple)):
+        return ('[]',) + tuple(freeze(item) for item in value)
+    return (type(value), value)
+
+
+def snapshot_change(self, *args, **kwargs):
+    raise TypeError('This is a snapshot of the template, change it through the add_* methods')
+
+
+class ReadOnlyDict(dict):
+    '''A dict in a template snapshot, see readonly()'''
+    __slots__ = ()
+
+    __setitem__ = __delitem__ = update = setdefault = pop = popitem = clear = snapshot_change
+
+    def __reduce__(self):
+        return dict, (dict(self),)
+
+
+class ReadOnlyList(list):
+    '''A list in a template snapshot, see readonly()'''
+    __slots__ = ()
+
+    __setitem__ = __delitem__ = __setslice__ = __delslice__ = __iadd__ = __imul__ = snapshot_change
+    append = extend = insert = remove = pop = sort = reverse = snapshot_change
+
+    def __reduce__(self):
+        return list, (list(self),)
+
+
+def readonly(value):
+    '''Copy of a template that raises on any change, so code written for the old live
+    Environment.env fails loudly instead of editing a throwaway dict. copy.deepcopy of it
+    gives plain dicts and lists again'''
+    if type(value) is Intrinsic:
+        return value
+    if isinstance(value, dict):
+        return ReadOnlyDict((key, readonly(value[key])) for key in value)
+    if isinstance(value, list):
+        return ReadOnlyList(readonly(item) for item in value)
+    return value
+
+
+def copy_args(value):
+    '''Private copy of the arguments so later changes to the caller's lists never reach a shared node'''
+    if isinstance(value, Intrinsic):
+        return value
+    if isinstance(value, dict):
+        return dict((key, copy_args(value[key])) for key in value)
+    if isinstance(value, (list, tuple)):
+        return [copy_args(item) for item in value]
+    return value
+
+
+def intrinsic(function, args, cache=INTRINSICS):
+    '''Returns the shared node for {function: args}, creating it on first use. Environment
+    passes its own plain dict as cache, the process wide default only holds nodes weakly'''
+    key = (function, args if isinstance(args, basestring) else freeze(args))
+    node = cache.get(key)
+    if node is None:
+        node = Intrinsic()
+        dict.__setitem__(node, function, copy_args(args))
+        cache[key] = node
+    return node
+
+
+class TemplateResource(object):
+    '''A resource as add_resource stores it, built into its template dict by materialize'''
+    __slots__ = ('type', 'properties', 'depends', 'designer_id')
+
+    def __init__(self, _type, properties, depends, designer_id):
+        self.type = _type
+        self.properties = properties
+        self.depends = depends
+        self.designer_id = designer_id
+
+    def materialize(self):
+        resource = {"Type": self.type, "Properties": self.properties}
+        if self.depends:
+            resource["DependsOn"] = self.depends
+        resource["Metadata"] = {
+            "AWS::CloudFormation::Designer": {
+                "id": self.designer_id
+            }
+        }
+        return resource
+
+
+class TemplateOutput(object):
+    '''An output as add_outputs stores it'''
+    __slots__ = ('value', 'description')
+
+    def __init__(self, value, description):
+        self.value = value
+        self.description = description
+
+    def materialize(self):
+        return {
+            "Value": self.value,
+            "Description": self.description
+        }
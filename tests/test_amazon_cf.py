@@ -0,0 +1,130 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import amazon_cf
+from amazon_cf import Environment
+
+
+def build():
+    env = Environment("test", fragments=None)
+    env.add_vpc("vpc", cidr_block="10.0.0.0/16")
+    env.add_subnet("first")
+    env.add_subnet("second")
+    env.add_role("role")
+    env.add_instance_profile("profile")
+    return env
+
+
+class ShardTest(unittest.TestCase):
+
+    def setUp(self):
+        self.env = build()
+        self.parent, self.children = self.env.shard(max_resources=1)
+        self.templates = dict(self.children)
+
+    def test_every_resource_lands_in_one_nested_template(self):
+        names = [name for stack, child in self.children for name in child["Resources"]]
+        self.assertEqual(sorted(names), sorted(self.env.resources))
+        self.assertEqual(sorted(self.parent["Resources"]), sorted(self.templates))
+
+    def test_cross_stack_references_become_parameters(self):
+        subnet = self.parent["Resources"]["Ec2Stack2"]
+        self.assertEqual(subnet["Properties"]["Parameters"]["Vpc"],
+                         {"Fn::GetAtt": ["Ec2Stack1", "Outputs.Vpc"]})
+        self.assertEqual(subnet["DependsOn"], ["Ec2Stack1"])
+        child = self.templates["Ec2Stack2"]
+        self.assertEqual(child["Resources"]["First"]["Properties"]["VpcId"], {"Ref": "Vpc"})
+        self.assertIn("Vpc", child["Parameters"])
+        self.assertEqual(self.templates["Ec2Stack1"]["Outputs"]["Vpc"]["Value"], {"Ref": "Vpc"})
+
+    def test_parent_keeps_every_output(self):
+        self.assertEqual(sorted(self.parent["Outputs"]), sorted(self.env.outputs))
+        self.assertEqual(self.parent["Outputs"]["Profile"]["Value"],
+                         {"Fn::GetAtt": ["IamStack2", "Outputs.Profile"]})
+        self.assertEqual(self.templates["IamStack2"]["Outputs"]["Profile"]["Value"],
+                         {"Ref": "Profile"})
+
+    def test_stack_name_comes_from_the_parent(self):
+        for stack, child in self.children:
+            self.assertNotIn("AWS::StackName", json.dumps(child))
+        subnet = self.parent["Resources"]["Ec2Stack2"]["Properties"]["Parameters"]
+        self.assertEqual(subnet["ParentStackName"], {"Ref": "AWS::StackName"})
+        self.assertIn("ParentStackName", self.templates["Ec2Stack2"]["Parameters"])
+        self.assertNotIn("ParentStackName", self.templates["Ec2Stack2"]["Outputs"])
+
+    def test_by_dependency_keeps_dependencies_in_earlier_stacks(self):
+        parent, children = build().shard(max_resources=2, by="dependency")
+        order = [stack for stack, child in children]
+        for stack in parent["Resources"]:
+            for target in parent["Resources"][stack].get("DependsOn", []):
+                self.assertLess(order.index(target), order.index(stack))
+
+
+class ShardLimitTest(unittest.TestCase):
+
+    def setUp(self):
+        self.limits = (amazon_cf.CF_OUTPUT_LIMIT, amazon_cf.CF_PARAMETER_LIMIT,
+                       amazon_cf.CF_RESOURCE_LIMIT)
+
+    def tearDown(self):
+        (amazon_cf.CF_OUTPUT_LIMIT, amazon_cf.CF_PARAMETER_LIMIT,
+         amazon_cf.CF_RESOURCE_LIMIT) = self.limits
+
+    def assertOverLimit(self, message, **kwargs):
+        with self.assertRaises(BaseException) as raised:
+            build().shard(**kwargs)
+        self.assertIn(message, str(raised.exception))
+
+    def test_nested_stack_parameters(self):
+        amazon_cf.CF_PARAMETER_LIMIT = 1
+        self.assertOverLimit("parameters, over the limit of 1", max_resources=1)
+
+    def test_nested_stack_resources(self):
+        amazon_cf.CF_RESOURCE_LIMIT = 2
+        self.assertOverLimit("Ec2Stack1 has 3 resources, over the limit of 2", max_resources=3)
+
+    def test_parent_resources(self):
+        amazon_cf.CF_RESOURCE_LIMIT = 4
+        self.assertOverLimit("The parent has 5 nested stacks, over the limit of 4", max_resources=1)
+
+    def test_parent_outputs(self):
+        amazon_cf.CF_OUTPUT_LIMIT = 4
+        self.assertOverLimit("The parent has 5 outputs, over the limit of 4", max_resources=5)
+
+
+class TemplateTest(unittest.TestCase):
+
+    def test_env_is_a_read_only_snapshot(self):
+        env = build()
+        self.assertRaises(TypeError, env.env["Resources"].__setitem__, "Extra", {})
+        self.assertRaises(TypeError, env.show_resources()["Outputs"].pop, "Vpc")
+        env.add_subnet("third")
+        self.assertIn("Third", env.env["Resources"])
+        self.assertEqual(json.loads(json.dumps(env.env)), json.loads(json.dumps(env.template())))
+
+
+class WriteNestedTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_nested_templates_are_named_by_content(self):
+        filename = os.path.join(self.directory, "parent.json")
+        paths = build().write_nested(filename, "https://s3.amazonaws.com/templates/", max_resources=2)
+        again = build().write_nested(filename, "https://s3.amazonaws.com/templates", max_resources=2)
+        self.assertEqual(paths, again)
+        with open(filename) as parent:
+            resources = json.load(parent)["Resources"]
+        urls = sorted(resources[stack]["Properties"]["TemplateURL"] for stack in resources)
+        self.assertEqual(urls, sorted("https://s3.amazonaws.com/templates/" + os.path.basename(path)
+                                      for path in paths))
+
+
+if __name__ == "__main__":
+    unittest.main()
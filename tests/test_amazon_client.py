@@ -0,0 +1,341 @@
+import datetime
+import os
+import shutil
+import tempfile
+import unittest
+
+import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from botocore.stub import ANY, Stubber
+
+import amazon_client
+from amazon_client import (CREATE_FAILURE, CREATE_SUCCESS, Cloudformation, StackError,
+                           StackOperation, StackPoller)
+
+BUCKET = 'templates'
+
+
+def stub_client(service, region='eu-west-1', max_pool_connections=amazon_client.DEFAULT_POOL_CONNECTIONS):
+    client = boto3.session.Session(
+        aws_access_key_id='testing', aws_secret_access_key='testing',
+        region_name=region).client(service, config=Config(max_pool_connections=max_pool_connections))
+    return client, Stubber(client)
+
+
+def stack_event(event_id, resource, status, resource_type='AWS::EC2::VPC'):
+    return {
+        'StackId': 'arn:aws:cloudformation:eu-west-1:123456789012:stack/test/1',
+        'StackName': 'test',
+        'EventId': event_id,
+        'LogicalResourceId': resource,
+        'ResourceType': resource_type,
+        'ResourceStatus': status,
+        'Timestamp': datetime.datetime(2020, 1, 1)
+    }
+
+
+def stack_status(event_id, status):
+    return stack_event(event_id, 'test', status, 'AWS::CloudFormation::Stack')
+
+
+class StubbedTestCase(unittest.TestCase):
+    '''Cloudformation on stubbed clients, every call it makes has to be queued on
+    self.cf_stub or self.s3_stub first'''
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.template = self.write('template.json', '{"Resources": {}}')
+        self.cf_client, self.cf_stub = stub_client('cloudformation')
+        self.s3, self.s3_stub = stub_client('s3')
+        clients = {'cloudformation': self.cf_client, 's3': self.s3}
+        self.get_client = amazon_client.get_client
+        amazon_client.get_client = lambda service, **kwargs: clients[service]
+        self.cf_stub.activate()
+        self.s3_stub.activate()
+
+    def tearDown(self):
+        amazon_client.get_client = self.get_client
+        self.cf_stub.deactivate()
+        self.s3_stub.deactivate()
+        shutil.rmtree(self.directory)
+
+    def write(self, name, body):
+        path = os.path.join(self.directory, name)
+        with open(path, 'w') as output:
+            output.write(body)
+        return path
+
+    def cloudformation(self, stored=False, **kwargs):
+        '''A Cloudformation for the fixed bucket BUCKET, which already exists. With
+        content_addressed, stored says whether the template is in it already'''
+        self.s3_stub.add_response('head_bucket', {}, {'Bucket': BUCKET})
+        key = self.template
+        if kwargs.get('content_addressed'):
+            key = amazon_client.file_digest(self.template) + '.json'
+            if stored:
+                self.s3_stub.add_response('head_object', {}, {'Bucket': BUCKET, 'Key': key})
+            else:
+                self.s3_stub.add_client_error('head_object', '404', http_status_code=404,
+                                              expected_params={'Bucket': BUCKET, 'Key': key})
+        if not stored:
+            self.s3_stub.add_response('put_object', {}, {'Bucket': BUCKET, 'Key': key, 'Body': ANY})
+        cf = Cloudformation('test', self.template, bucket_name=BUCKET,
+                            randomize_bucket=False, **kwargs)
+        cf.upload_to_s3()
+        self.s3_stub.assert_no_pending_responses()
+        return cf
+
+
+class TailEventsTest(StubbedTestCase):
+
+    def test_fail_fast_raises_on_first_failed_resource(self):
+        cf = self.cloudformation()
+        self.cf_stub.add_response('describe_stack_events', {'StackEvents': [
+            stack_event('3', 'Vpc', 'CREATE_FAILED'),
+            stack_event('2', 'Vpc', 'CREATE_IN_PROGRESS'),
+            stack_status('1', 'CREATE_IN_PROGRESS')
+        ]}, {'StackName': 'test'})
+        seen = []
+        with self.assertRaises(StackError):
+            for event in cf.tail_events(min_interval=0):
+                seen.append(event['EventId'])
+        self.assertEqual(seen, ['1', '2', '3'])
+        self.cf_stub.assert_no_pending_responses()
+
+    def test_without_fail_fast_waits_for_the_stack(self):
+        cf = self.cloudformation()
+        self.cf_stub.add_response('describe_stack_events', {'StackEvents': [
+            stack_event('2', 'Vpc', 'CREATE_FAILED'),
+            stack_status('1', 'CREATE_IN_PROGRESS')
+        ]}, {'StackName': 'test'})
+        self.cf_stub.add_response('describe_stack_events', {'StackEvents': [
+            stack_status('4', 'ROLLBACK_COMPLETE'),
+            stack_status('3', 'ROLLBACK_IN_PROGRESS'),
+            stack_event('2', 'Vpc', 'CREATE_FAILED')
+        ]}, {'StackName': 'test'})
+        seen = []
+        with self.assertRaises(StackError):
+            for event in cf.tail_events(fail_fast=False, min_interval=0):
+                seen.append(event['EventId'])
+        self.assertEqual(seen, ['1', '2', '3', '4'])
+        self.cf_stub.assert_no_pending_responses()
+
+    def test_new_events_skips_repeats_across_pages(self):
+        cf = self.cloudformation()
+        self.cf_stub.add_response('describe_stack_events', {'StackEvents': [
+            stack_event('3', 'Vpc', 'CREATE_COMPLETE'),
+            stack_event('2', 'Vpc', 'CREATE_IN_PROGRESS')
+        ], 'NextToken': 'page2'}, {'StackName': 'test'})
+        self.cf_stub.add_response('describe_stack_events', {'StackEvents': [
+            stack_event('2', 'Vpc', 'CREATE_IN_PROGRESS'),
+            stack_status('1', 'CREATE_IN_PROGRESS')
+        ]}, {'StackName': 'test', 'NextToken': 'page2'})
+        events = cf.new_events(set(), None)
+        self.assertEqual([event['EventId'] for event in events], ['1', '2', '3'])
+
+
+class UploadFilesTest(StubbedTestCase):
+
+    def test_content_addressed_skips_files_already_uploaded(self):
+        cf = self.cloudformation()
+        old = self.write('old.json', '{"old": true}')
+        new = self.write('new.json', '{"new": true}')
+        old_key = amazon_client.file_digest(old) + '.json'
+        new_key = amazon_client.file_digest(new) + '.json'
+        self.s3_stub.add_response('head_object', {}, {'Bucket': BUCKET, 'Key': old_key})
+        self.s3_stub.add_client_error('head_object', '404', http_status_code=404,
+                                      expected_params={'Bucket': BUCKET, 'Key': new_key})
+        self.s3_stub.add_response('put_object', {}, {'Bucket': BUCKET, 'Key': new_key, 'Body': ANY})
+        report = cf.upload_files([old, new], content_addressed=True, max_workers=1)
+        self.assertEqual((report['uploaded'], report['skipped']), (1, 1))
+        self.assertEqual([result['skipped'] for result in report['files']], [True, False])
+        self.assertEqual(report['bytes'], os.path.getsize(new))
+        self.s3_stub.assert_no_pending_responses()
+
+    def test_files_over_the_threshold_go_multipart(self):
+        cf = self.cloudformation()
+        artifact = self.write('artifact.bin', 'x' * 4096)
+        key = 'test/artifact.bin'
+        self.s3_stub.add_response('create_multipart_upload', {'UploadId': 'upload'},
+                                  {'Bucket': BUCKET, 'Key': key})
+        self.s3_stub.add_response('upload_part', {'ETag': '"part"'}, {
+            'Bucket': BUCKET, 'Key': key, 'UploadId': 'upload', 'PartNumber': 1, 'Body': ANY})
+        self.s3_stub.add_response('complete_multipart_upload', {}, {
+            'Bucket': BUCKET, 'Key': key, 'UploadId': 'upload',
+            'MultipartUpload': {'Parts': [{'ETag': '"part"', 'PartNumber': 1}]}})
+        report = cf.upload_files([artifact], prefix='test/', multipart_threshold=1024)
+        self.assertEqual((report['uploaded'], report['bytes']), (1, 4096))
+        self.s3_stub.assert_no_pending_responses()
+
+    def test_pool_has_a_connection_for_every_part_in_flight(self):
+        cf = self.cloudformation()
+        files = [self.write('{}.json'.format(number), '{}') for number in range(3)]
+        s3, s3_stub = stub_client('s3', max_pool_connections=12)
+        requested = []
+
+        def get_client(service, **kwargs):
+            requested.append((service, kwargs['max_pool_connections']))
+            return s3
+
+        amazon_client.get_client = get_client
+        for number in range(3):
+            s3_stub.add_response('put_object', {})
+        with s3_stub:
+            report = cf.upload_files(files, max_workers=8, multipart_concurrency=4)
+            s3_stub.assert_no_pending_responses()
+        self.assertEqual(report['uploaded'], 3)
+        self.assertEqual(requested, [('s3', 12)])
+        self.assertIs(cf.s3, s3)
+        cf.upload_files([], max_workers=8, multipart_concurrency=4)
+        self.assertEqual(requested, [('s3', 12)])
+
+
+class UploadToS3Test(StubbedTestCase):
+
+    def test_unchanged_template_is_not_uploaded_again(self):
+        cf = self.cloudformation(content_addressed=True, stored=True)
+        key = amazon_client.file_digest(self.template) + '.json'
+        self.assertEqual(cf.key, key)
+        self.assertEqual(cf.stack_request()['TemplateURL'],
+                         'https://s3.amazonaws.com/{}/{}'.format(BUCKET, key))
+
+    def test_changed_template_is_uploaded_under_its_digest(self):
+        cf = self.cloudformation(content_addressed=True)
+        self.assertEqual(cf.key, amazon_client.file_digest(self.template) + '.json')
+
+
+class DeployTest(StubbedTestCase):
+
+    def test_unchanged_update_touches_nothing_in_s3(self):
+        cf = Cloudformation('test', self.template)
+        self.cf_stub.add_response('describe_stacks', {'Stacks': [{
+            'StackName': 'test', 'StackStatus': 'CREATE_COMPLETE',
+            'CreationTime': datetime.datetime(2020, 1, 1)}]}, {'StackName': 'test'})
+        self.cf_stub.add_response('get_template', {'TemplateBody': '{"Resources": {}}'},
+                                  {'StackName': 'test'})
+        self.assertFalse(cf.deploy()['changed'])
+        self.assertFalse(cf.uploaded)
+        self.cf_stub.assert_no_pending_responses()
+
+
+class CreateBucketTest(StubbedTestCase):
+
+    def test_existing_fixed_bucket_is_reused(self):
+        cf = self.cloudformation()
+        self.s3_stub.add_response('head_bucket', {}, {'Bucket': BUCKET})
+        cf.create_bucket()
+        self.s3_stub.assert_no_pending_responses()
+
+    def test_missing_fixed_bucket_is_created_in_the_region(self):
+        cf = self.cloudformation()
+        self.s3_stub.add_client_error('head_bucket', '404', http_status_code=404)
+        self.s3_stub.add_response('create_bucket', {}, {
+            'Bucket': BUCKET, 'CreateBucketConfiguration': {'LocationConstraint': 'eu-west-1'}})
+        cf.create_bucket()
+        self.s3_stub.assert_no_pending_responses()
+
+
+    def test_bucket_in_us_east_1_has_no_location_constraint(self):
+        cf = self.cloudformation()
+        cf.s3, stub = stub_client('s3', region='us-east-1')
+        stub.add_client_error('head_bucket', '404', http_status_code=404)
+        stub.add_response('create_bucket', {}, {'Bucket': BUCKET})
+        with stub:
+            cf.create_bucket()
+            stub.assert_no_pending_responses()
+
+
+
+def client_error(code, message):
+    return ClientError({'Error': {'Code': code, 'Message': message}}, 'DescribeStacks')
+
+
+class FakeCloudformation(object):
+    '''describe_stacks answers from statuses, name -> list of statuses or errors, the last
+    one repeating. Every call is recorded in calls'''
+
+    def __init__(self, statuses):
+        self.statuses = statuses
+        self.calls = []
+
+    def describe_stacks(self, StackName):
+        self.calls.append(StackName)
+        answers = self.statuses[StackName]
+        answer = answers.pop(0) if len(answers) > 1 else answers[0]
+        if isinstance(answer, Exception):
+            raise answer
+        return {'Stacks': [{'StackName': StackName, 'StackStatus': answer}]}
+
+
+def create_operation(client, name, cancel=None):
+    return StackOperation(client, name, CREATE_SUCCESS, CREATE_FAILURE, cancel=cancel)
+
+
+class StackPollerTest(unittest.TestCase):
+
+    def test_each_tick_describes_only_the_watched_stacks(self):
+        client = FakeCloudformation({'a': ['CREATE_IN_PROGRESS'], 'b': ['CREATE_COMPLETE']})
+        operations = [create_operation(client, 'a'), create_operation(client, 'b')]
+        StackPoller().poll(operations)
+        self.assertEqual(client.calls, ['a', 'b'])
+        self.assertEqual([operation.status for operation in operations],
+                         ['CREATE_IN_PROGRESS', 'CREATE_COMPLETE'])
+        self.assertEqual([operation.done() for operation in operations], [False, True])
+
+    def test_throttling_waits_for_the_next_tick(self):
+        client = FakeCloudformation({
+            'a': [client_error('Throttling', 'Rate exceeded'), 'CREATE_COMPLETE'],
+            'b': ['CREATE_COMPLETE']
+        })
+        operations = [create_operation(client, 'a'), create_operation(client, 'b')]
+        poller = StackPoller()
+        poller.poll(operations)
+        self.assertEqual(client.calls, ['a'])
+        self.assertFalse(any(operation.done() for operation in operations))
+        poller.poll(operations)
+        self.assertEqual([operation.result(0) for operation in operations],
+                         ['CREATE_COMPLETE', 'CREATE_COMPLETE'])
+
+    def test_other_errors_fail_the_operation(self):
+        client = FakeCloudformation({'a': [client_error('AccessDenied', 'Not allowed')]})
+        operation = create_operation(client, 'a')
+        StackPoller().poll([operation])
+        self.assertRaises(ClientError, operation.result, 0)
+
+    def test_a_stack_that_disappears_has_been_deleted(self):
+        client = FakeCloudformation({'a': [
+            'CREATE_IN_PROGRESS', client_error('ValidationError', 'Stack with id a does not exist')]})
+        operation = create_operation(client, 'a')
+        poller = StackPoller()
+        poller.poll([operation])
+        poller.poll([operation])
+        self.assertEqual(operation.status, 'DELETE_COMPLETE')
+        self.assertRaises(StackError, operation.result, 0)
+
+    def test_interval_backs_off_until_something_changes(self):
+        poller = StackPoller(min_interval=2, max_interval=10, backoff=2)
+        intervals = [2]
+        for changed in (False, False, False, True, False):
+            intervals.append(poller.next_interval(intervals[-1], changed))
+        self.assertEqual(intervals, [2, 4, 8, 10, 2, 4])
+
+    def test_cancel_deletes_and_the_poller_sees_it_through(self):
+        client = FakeCloudformation({'a': ['CREATE_IN_PROGRESS']})
+        cancelled = []
+
+        def cancel():
+            cancelled.append('a')
+            client.statuses['a'] = ['DELETE_IN_PROGRESS', 'DELETE_COMPLETE']
+
+        poller = StackPoller(min_interval=0.01, max_interval=0.02)
+        operation = poller.watch(create_operation(client, 'a', cancel=cancel))
+        self.assertTrue(operation.cancel())
+        self.assertRaises(StackError, operation.result, 5)
+        self.assertEqual(operation.status, 'DELETE_COMPLETE')
+        self.assertEqual(cancelled, ['a'])
+        self.assertFalse(operation.cancel())
+
+
+if __name__ == '__main__':
+    unittest.main()
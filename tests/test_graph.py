@@ -0,0 +1,61 @@
+import unittest
+
+from graph import DependencyCycle, DependencyGraph, as_list
+
+
+def ref(name):
+    return {"Ref": name}
+
+
+class DependencyGraphTest(unittest.TestCase):
+
+    def test_depends_on_a_referenced_resource_is_redundant(self):
+        graph = DependencyGraph([
+            ("Vpc", None, {}),
+            ("Subnet", "Vpc", {"VpcId": ref("Vpc")})
+        ])
+        self.assertEqual(graph.redundant(), [("Subnet", "Vpc")])
+
+    def test_depends_on_reached_through_another_dependency_is_redundant(self):
+        graph = DependencyGraph([
+            ("Vpc", None, {}),
+            ("Subnet", None, {"VpcId": ref("Vpc")}),
+            ("Instance", ["Vpc", "Subnet"], {})
+        ])
+        self.assertEqual(graph.redundant(), [("Instance", "Vpc")])
+
+    def test_needed_depends_on_is_kept(self):
+        graph = DependencyGraph([
+            ("Gateway", None, {}),
+            ("Vpc", None, {}),
+            ("Route", "Gateway", {"VpcId": ref("Vpc")}),
+            ("Instance", ["Route"], {"Tags": [{"Value": {"Fn::GetAtt": ["Vpc", "CidrBlock"]}}]})
+        ])
+        self.assertEqual(graph.redundant(), [])
+
+    def test_dropping_every_redundant_entry_keeps_reachability(self):
+        resources = [
+            ("A", None, {}),
+            ("B", "A", {"A": ref("A")}),
+            ("C", ["A", "B"], {"B": ref("B")}),
+            ("D", ["A", "B", "C"], {"C": {"Fn::GetAtt": ["C", "Arn"]}})
+        ]
+        graph = DependencyGraph(resources)
+        redundant = set(graph.redundant())
+        pruned = DependencyGraph([
+            (name, [target for target in as_list(depends) if (name, target) not in redundant], properties)
+            for name, depends, properties in resources])
+        self.assertEqual(pruned.reachable(), graph.reachable())
+        self.assertEqual(pruned.redundant(), [])
+
+    def test_refs_to_parameters_are_not_edges(self):
+        graph = DependencyGraph([("Vpc", None, {"Tags": [{"Value": ref("AWS::StackName")}]})])
+        self.assertEqual(graph.depends, {"Vpc": []})
+
+    def test_cycles_are_reported(self):
+        graph = DependencyGraph([("A", "B", {}), ("B", None, {"A": ref("A")})])
+        self.assertRaises(DependencyCycle, graph.redundant)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,203 @@
+import BaseHTTPServer
+import json
+import os
+import shutil
+import SocketServer
+import tempfile
+import threading
+import time
+import unittest
+
+import netaddr
+
+from helper import (IAM_POLICY_LIMITS, ContainerDefinition, SubnetAllocator, UserPolicy, VariableResolver,
+                    get_my_ip, valid_ip)
+
+
+class SubnetAllocatorTest(unittest.TestCase):
+
+    def test_allocate_matches_netaddr_subnets(self):
+        allocator = SubnetAllocator("10.0.0.0/16")
+        expected = [str(subnet) for subnet in netaddr.IPNetwork("10.0.0.0/16").subnet(24, count=5)]
+        self.assertEqual([allocator.allocate() for _ in range(5)], expected)
+
+    def test_allocate_skips_reserved_blocks(self):
+        allocator = SubnetAllocator("10.0.0.0/22")
+        self.assertEqual(allocator.reserve("10.0.1.0/24"), "10.0.1.0/24")
+        self.assertEqual([allocator.allocate() for _ in range(3)],
+                         ["10.0.0.0/24", "10.0.2.0/24", "10.0.3.0/24"])
+        self.assertRaises(BaseException, allocator.allocate)
+
+    def test_mixed_sizes_never_overlap(self):
+        allocator = SubnetAllocator("10.0.0.0/22")
+        allocator.reserve("10.0.2.128/25")
+        blocks = [allocator.allocate(25), allocator.allocate(23), allocator.allocate(24)]
+        self.assertEqual(blocks, ["10.0.2.0/25", "10.0.0.0/23", "10.0.3.0/24"])
+        networks = [netaddr.IPNetwork(block) for block in blocks + ["10.0.2.128/25"]]
+        for index, network in enumerate(networks):
+            for other in networks[index + 1:]:
+                self.assertFalse(network in other or other in network, (network, other))
+
+    def test_reserve_rejects_overlaps(self):
+        allocator = SubnetAllocator("10.0.0.0/22")
+        allocator.allocate(23)
+        self.assertRaises(BaseException, allocator.reserve, "10.0.1.0/24")
+        self.assertRaises(BaseException, allocator.reserve, "10.0.0.0/22")
+        self.assertRaises(BaseException, allocator.reserve, "10.1.0.0/24")
+
+    def test_release_merges_buddies(self):
+        allocator = SubnetAllocator("10.0.0.0/22")
+        blocks = [allocator.allocate() for _ in range(4)]
+        self.assertRaises(BaseException, allocator.allocate, 22)
+        for block in reversed(blocks):
+            allocator.release(block)
+        self.assertEqual(allocator.allocate(22), "10.0.0.0/22")
+
+    def test_release_of_reserved_block_frees_it(self):
+        allocator = SubnetAllocator("10.0.0.0/23")
+        allocator.reserve("10.0.1.0/24")
+        allocator.release("10.0.1.0/24")
+        self.assertEqual(allocator.allocate(23), "10.0.0.0/23")
+
+    def test_release_rejects_unallocated_blocks(self):
+        allocator = SubnetAllocator("10.0.0.0/22")
+        allocator.allocate()
+        self.assertRaises(BaseException, allocator.release, "10.0.1.0/24")
+
+
+class UserPolicyTest(unittest.TestCase):
+
+    def test_pack_merges_statements_into_one_policy(self):
+        policy = UserPolicy("docker")
+        policy.add_statement(["s3:GetObject", "s3:PutObject"], resource="arn:aws:s3:::bucket/*")
+        policy.add_statement(["s3:*", "ec2:DescribeInstances"])
+        policy.add_statement(["s3:GetObject", "S3:getobject"], resource="arn:aws:s3:::bucket/*")
+        policy.add_statement(["ec2:DescribeInstances", "s3:ListBucket"])
+        policies = policy.pack()
+        self.assertEqual(len(policies), 1)
+        self.assertEqual(policies[0]["PolicyName"], "docker0")
+        self.assertEqual(policies[0]["PolicyDocument"]["Statement"], [
+            {"Effect": "Allow", "Resource": "arn:aws:s3:::bucket/*",
+             "Action": ["s3:GetObject", "s3:PutObject"]},
+            {"Effect": "Allow", "Resource": "*", "Action": ["s3:*", "ec2:DescribeInstances"]}
+        ])
+
+    def test_pack_raises_over_the_entity_limit(self):
+        policy = UserPolicy("docker")
+        for number in range(60):
+            policy.add_statement(["s3:GetObject"], resource="arn:aws:s3:::bucket{}/*".format(number))
+        document = policy.pack("role")[0]["PolicyDocument"]
+        size = len(json.dumps(document, separators=(',', ':')))
+        self.assertTrue(IAM_POLICY_LIMITS["user"] < size <= IAM_POLICY_LIMITS["role"])
+        self.assertRaises(BaseException, policy.pack, "user")
+        self.assertRaises(BaseException, policy.pack, "robot")
+
+
+
+class StaticSource(object):
+
+    def __init__(self, values):
+        self.values = values
+        self.calls = 0
+
+    def fetch(self, keys):
+        self.calls += 1
+        return dict((key, self.values[key]) for key in keys if key in self.values)
+
+
+class VariableResolverTest(unittest.TestCase):
+
+    def test_containers_do_not_share_environment_lists(self):
+        source = StaticSource({"MAIL_SERVER": "smtp", "MAIL_PORT": "465"})
+        resolver = VariableResolver([source])
+        first = ContainerDefinition(Name="web", Environment=resolver.aws_list(["MAIL_SERVER", "MAIL_PORT"]))
+        second = ContainerDefinition(Name="worker", Environment=resolver.aws_list(["MAIL_SERVER", "MAIL_PORT"]))
+        self.assertEqual(source.calls, 1)
+        first.object["Environment"].append({"Name": "DEBUG", "Value": "1"})
+        first.object["Environment"][0]["Value"] = "changed"
+        self.assertEqual(second.object["Environment"], resolver.aws_list(["MAIL_SERVER", "MAIL_PORT"]))
+        self.assertEqual(len(second.object["Environment"]), 2)
+        self.assertNotIn("changed", [entry["Value"] for entry in second.object["Environment"]])
+
+
+class IpProvider(BaseHTTPServer.BaseHTTPRequestHandler):
+    '''Answers GET /<delay>/<body> with body after delay seconds'''
+
+    def do_GET(self):
+        delay, body = self.path.lstrip("/").split("/", 1)
+        time.sleep(float(delay))
+        self.send_response(200)
+        self.end_headers()
+        self.wfile.write(body + "\n")
+
+    def log_message(self, *args):
+        pass
+
+
+class ThreadingServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class GetMyIpTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = ThreadingServer(("127.0.0.1", 0), IpProvider)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.directory = tempfile.mkdtemp()
+        self.override = os.environ.pop("MY_IP", None)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.directory)
+        if self.override is not None:
+            os.environ["MY_IP"] = self.override
+
+    def provider(self, body, delay=0):
+        return "http://127.0.0.1:{}/{}/{}".format(self.server.server_address[1], delay, body)
+
+    def test_valid_ip_needs_four_octets(self):
+        self.assertEqual(valid_ip(" 203.0.113.7\n"), "203.0.113.7")
+        self.assertEqual(valid_ip("2001:db8::1"), "2001:db8::1")
+        for text in ["1", "127.1", "10.1.2", "203.0.113.256", "not an ip", ""]:
+            self.assertIsNone(valid_ip(text), text)
+
+    def test_first_valid_answer_wins(self):
+        providers = [self.provider("198.51.100.1", delay=1), self.provider("203.0.113.7")]
+        self.assertEqual(get_my_ip(providers=providers, timeout=2), "203.0.113.7/32")
+
+    def test_short_forms_are_not_answers(self):
+        providers = [self.provider("127.1"), self.provider("1"), self.provider("203.0.113.7", delay=0.2)]
+        self.assertEqual(get_my_ip("/24", providers=providers, timeout=2), "203.0.113.7/24")
+        self.assertRaises(BaseException, get_my_ip, providers=providers[:2], timeout=2)
+
+    def test_slow_providers_time_out(self):
+        started = time.time()
+        self.assertRaises(BaseException, get_my_ip, providers=[self.provider("203.0.113.7", delay=2)],
+                          timeout=0.5)
+        self.assertLess(time.time() - started, 1.5)
+
+    def test_environment_overrides_providers(self):
+        os.environ["MY_IP"] = "192.0.2.1/32"
+        try:
+            self.assertEqual(get_my_ip(providers=[self.provider("garbage")]), "192.0.2.1/32")
+        finally:
+            del os.environ["MY_IP"]
+
+    def test_cache_is_opt_in(self):
+        cache_file = os.path.join(self.directory, "my_ip")
+        self.assertEqual(get_my_ip(providers=[self.provider("203.0.113.7")], cache_file=cache_file),
+                         "203.0.113.7/32")
+        self.assertEqual(os.listdir(self.directory), ["my_ip"])
+        self.assertEqual(get_my_ip(providers=[self.provider("garbage")], cache_file=cache_file),
+                         "203.0.113.7/32")
+        self.assertEqual(get_my_ip(providers=[self.provider("198.51.100.1")], cache_file=cache_file, ttl=-1),
+                         "198.51.100.1/32")
+        self.assertEqual(get_my_ip(providers=[self.provider("192.0.2.1")]), "192.0.2.1/32")
+        self.assertEqual(os.listdir(self.directory), ["my_ip"])
+
+
+if __name__ == "__main__":
+    unittest.main()
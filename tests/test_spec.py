@@ -0,0 +1,56 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import spec
+from spec import Specification, build_cache, compile_spec
+
+
+class SpecificationCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.spec_file = os.path.join(self.directory, "specification.json")
+        self.cache_file = os.path.join(self.directory, "specification.cache")
+        shutil.copy(spec.SPEC_FILE, self.spec_file)
+        with open(self.spec_file) as source:
+            self.compiled = compile_spec(json.load(source))
+
+    def tearDown(self):
+        os.chmod(self.directory, 0o755)
+        shutil.rmtree(self.directory)
+
+    def assertMatchesSpec(self, specification):
+        for name in self.compiled:
+            self.assertEqual(specification.schema(name), self.compiled[name])
+
+    def test_reading_never_writes_the_cache(self):
+        specification = Specification(self.spec_file, self.cache_file)
+        self.assertEqual(os.listdir(self.directory), ["specification.json"])
+        self.assertIsNotNone(specification.compiled)
+        self.assertMatchesSpec(specification)
+
+    def test_built_cache_is_read_through_the_index(self):
+        self.assertEqual(build_cache(self.spec_file, self.cache_file), len(self.compiled))
+        self.assertEqual(sorted(os.listdir(self.directory)), ["specification.cache", "specification.json"])
+        specification = Specification(self.spec_file, self.cache_file)
+        self.assertIsNone(specification.compiled)
+        self.assertMatchesSpec(specification)
+
+    def test_failed_build_leaves_no_temporary_file(self):
+        os.mkdir(self.cache_file)
+        self.assertRaises(OSError, build_cache, self.spec_file, self.cache_file)
+        self.assertEqual(sorted(os.listdir(self.directory)), ["specification.cache", "specification.json"])
+
+    def test_read_only_install_compiles_in_memory(self):
+        os.chmod(self.directory, 0o555)
+        if os.access(self.directory, os.W_OK):
+            self.skipTest("running as a user that ignores permissions")
+        self.assertRaises(IOError, build_cache, self.spec_file, self.cache_file)
+        self.assertMatchesSpec(Specification(self.spec_file, self.cache_file))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,43 @@
+import copy
+import json
+import unittest
+
+from template import intrinsic, readonly
+
+
+class IntrinsicTest(unittest.TestCase):
+
+    def test_equal_arguments_share_one_node(self):
+        cache = {}
+        first = intrinsic("Fn::Join", ["", [intrinsic("Ref", "AWS::StackName", cache), "-web"]], cache)
+        second = intrinsic("Fn::Join", ["", [intrinsic("Ref", "AWS::StackName", cache), "-web"]], cache)
+        self.assertIs(first, second)
+
+    def test_scalars_of_different_types_are_different_nodes(self):
+        cache = {}
+        nodes = [intrinsic("Fn::Select", [index, ["a", "b"]], cache) for index in (True, 1, 1.0)]
+        self.assertEqual([json.dumps(node) for node in nodes], [
+            '{"Fn::Select": [true, ["a", "b"]]}',
+            '{"Fn::Select": [1, ["a", "b"]]}',
+            '{"Fn::Select": [1.0, ["a", "b"]]}'
+        ])
+
+
+class ReadOnlyTest(unittest.TestCase):
+
+    def test_changes_to_a_snapshot_raise(self):
+        snapshot = readonly({"Resources": {"Vpc": {"Tags": [{"Key": "Name"}]}}})
+        self.assertRaises(TypeError, snapshot["Resources"].__setitem__, "Subnet", {})
+        self.assertRaises(TypeError, snapshot["Resources"]["Vpc"]["Tags"].append, {})
+        self.assertRaises(TypeError, snapshot["Resources"]["Vpc"]["Tags"][0].update, {"Key": "x"})
+
+    def test_deepcopy_gives_a_plain_template(self):
+        snapshot = readonly({"Resources": {"Vpc": {"Tags": [{"Key": "Name"}]}}})
+        template = copy.deepcopy(snapshot)
+        template["Resources"]["Vpc"]["Tags"].append({"Key": "Owner"})
+        self.assertEqual(type(template["Resources"]), dict)
+        self.assertEqual(len(snapshot["Resources"]["Vpc"]["Tags"]), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()